@@ -0,0 +1,233 @@
+# bench_pipeline.py
+"""Benchmarks of the pywaveclus stages on synthetic recordings with known spike trains.
+
+Each configuration (number of channels, duration, firing rate) generates a deterministic
+ground-truth recording with spikeinterface, filters it into the bp2 and bp4 recordings the
+pipeline expects, and runs spike detection, waveform extraction, artifacts removal, feature
+extraction and SPC clustering one stage at a time. For each stage it reports the wall and
+CPU time, throughput (spikes/s and channel-hours/s) and peak memory, and for the whole run
+the detection recall and the sorting accuracy against the ground truth.
+
+The stages use the settings of pywaveclus/config.yaml, which are stored with the results.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.bench_pipeline --channels 4 16 --durations 60 300 --rates 5 20 --output bench.json
+"""
+import argparse
+import json
+import time
+import numpy as np
+from spikeinterface.core import generate_ground_truth_recording
+from spikeinterface.preprocessing import bandpass_filter
+from spclustering import SPC
+from pywaveclus.spike_detection import detect_spikes, load_spike_detection_config
+from pywaveclus.waveform_extraction import extract_waveforms, load_waveform_extraction_config
+from pywaveclus.artifacts_removal import artifacts_removal_for_bundle
+from pywaveclus.feature_extraction import feature_extraction, load_feature_extraction_config
+from pywaveclus.clustering import load_clustering_config
+from pywaveclus.instrumentation import PipelineProfiler, peak_rss_mb
+
+
+def make_recordings(num_channels, duration, firing_rate, seed=0, sampling_frequency=30000., num_units=None, materialize=True):
+    """Generates a synthetic recording with known spike trains, and its bp2 and bp4 versions.
+
+    Args:
+        num_channels (int): Number of channels.
+        duration (float): Duration in seconds.
+        firing_rate (float): Firing rate of every unit, in Hz.
+        seed (int): Seed of the spike trains, templates and noise.
+        sampling_frequency (float): Sampling frequency in Hz.
+        num_units (int): Number of units, 2 per channel by default.
+        materialize (bool): Keep the filtered traces in memory, so the stage timings do not
+                            include generating and filtering the data.
+
+    Returns:
+        tuple: The raw recording, the bp2 and bp4 recordings and the ground-truth sorting.
+    """
+    recording, gt_sorting = generate_ground_truth_recording(
+        durations=[duration], sampling_frequency=sampling_frequency, num_channels=num_channels,
+        num_units=num_units or 2 * num_channels, seed=seed,
+        generate_sorting_kwargs={'firing_rates': firing_rate, 'refractory_period_ms': 4.0})
+    recording_bp2 = bandpass_filter(recording, freq_min=300, freq_max=3000, filter_order=2)
+    recording_bp4 = bandpass_filter(recording, freq_min=300, freq_max=3000, filter_order=4)
+    if materialize:
+        recording_bp2 = recording_bp2.save(format='memory', progress_bar=False)
+        recording_bp4 = recording_bp4.save(format='memory', progress_bar=False)
+    return recording, recording_bp2, recording_bp4, gt_sorting
+
+
+def detection_recall(results, gt_sorting, delta_frames):
+    """Fraction of ground-truth spikes with a detected spike, on any channel, within `delta_frames`."""
+    gt_frames = np.sort(gt_sorting.to_spike_vector()['sample_index'])
+    detected = np.unique(np.concatenate([np.asarray(result['indexes'], dtype=np.int64) for result in results.values()]))
+    if len(gt_frames) == 0 or len(detected) == 0:
+        return 0.0
+    position = np.clip(np.searchsorted(detected, gt_frames), 1, len(detected) - 1)
+    distance = np.minimum(np.abs(detected[position] - gt_frames), np.abs(detected[position - 1] - gt_frames))
+    return float(np.mean(distance <= delta_frames))
+
+
+def sorting_accuracy(results, labels, gt_sorting, delta_frames):
+    """Compares the clusters of all channels with the ground-truth units.
+
+    Every (channel, cluster) pair is a tested unit, and each ground-truth spike is matched
+    with the detected spikes within `delta_frames` of it. The accuracy of a ground-truth
+    unit against a cluster is matches / (gt spikes + cluster spikes - matches), as in
+    spikeinterface, and each ground-truth unit is scored with its best cluster, so a unit
+    seen on several channels is not penalized. Unassigned spikes (label 0) are left out.
+
+    Returns:
+        dict: The mean accuracy of the ground-truth units, and the number of units with an
+              accuracy of at least 0.8.
+    """
+    samples = []
+    clusters = []
+    for channel_id, channel_labels in labels.items():
+        channel_labels = np.asarray(channel_labels)
+        assigned = channel_labels != 0
+        samples.append(np.asarray(results[channel_id]['indexes'], dtype=np.int64)[assigned])
+        clusters.extend(f'{channel_id}_{label}' for label in channel_labels[assigned])
+    samples = np.concatenate(samples) if samples else np.array([], dtype=np.int64)
+    cluster_ids, cluster_index = np.unique(np.array(clusters, dtype=str), return_inverse=True)
+    cluster_sizes = np.bincount(cluster_index, minlength=len(cluster_ids))
+
+    spike_vector = gt_sorting.to_spike_vector()
+    gt_frames = spike_vector['sample_index'].astype(np.int64)
+    gt_units = spike_vector['unit_index']
+    num_gt_units = len(gt_sorting.get_unit_ids())
+    gt_sizes = np.bincount(gt_units, minlength=num_gt_units)
+
+    # Count the (gt unit, cluster) pairs of the tested spikes within delta_frames of a gt spike
+    matches = np.zeros((num_gt_units, len(cluster_ids)), dtype=np.int64)
+    order = np.argsort(samples, kind='stable')
+    samples, cluster_index = samples[order], cluster_index[order]
+    first = np.searchsorted(samples, gt_frames - delta_frames, side='left')
+    last = np.searchsorted(samples, gt_frames + delta_frames, side='right')
+    for offset in range(int((last - first).max(initial=0))):
+        paired = first + offset < last
+        np.add.at(matches, (gt_units[paired], cluster_index[first[paired] + offset]), 1)
+    # Units and clusters are refractory, so a spike is rarely paired twice; keep accuracies <= 1
+    matches = np.minimum(matches, np.minimum(gt_sizes[:, np.newaxis], cluster_sizes[np.newaxis, :]))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accuracy = matches / (gt_sizes[:, np.newaxis] + cluster_sizes[np.newaxis, :] - matches)
+    accuracy = np.nan_to_num(accuracy).max(axis=1, initial=0)
+    return {
+        'accuracy': float(accuracy.mean()) if num_gt_units else 0.0,
+        'well_detected_units': int(np.sum(accuracy >= 0.8)),
+        'gt_units': num_gt_units,
+    }
+
+
+def run_benchmark(num_channels, duration, firing_rate, seed=0, trace_memory=True, clustering=True, materialize=True):
+    """Runs every stage once on a synthetic recording.
+
+    Returns:
+        dict: The configuration, per-stage timings, throughput and memory, and the accuracy.
+    """
+    recording, recording_bp2, recording_bp4, gt_sorting = make_recordings(num_channels, duration, firing_rate, seed, materialize=materialize)
+    sr = recording.get_sampling_frequency()
+    channel_hours = num_channels * duration / 3600
+    profiler = PipelineProfiler(trace_memory=trace_memory, verbose=False)
+
+    with profiler.stage('detect_spikes'):
+        results = detect_spikes(recording, recording_bp2, recording_bp4)
+    with profiler.stage('extract_waveforms'):
+        waveforms = extract_waveforms(results, recording_bp2)
+    with profiler.stage('artifacts_removal'):
+        bundle_dict = {'synthetic': [{'channel_id': channel_id} for channel_id in recording.get_channel_ids()]}
+        filtered_results, _ = artifacts_removal_for_bundle(results, bundle_dict, sr=sr)
+    with profiler.stage('feature_extraction'):
+        features = feature_extraction(waveforms)
+    labels = None
+    if clustering:
+        # As SPC_clustering, without the temperature plots
+        min_clus = load_clustering_config()['min_clus']
+        with profiler.stage('SPC_clustering'):
+            labels = {channel_id: SPC(mintemp=0, maxtemp=0.251).fit(feature, min_clus) for channel_id, feature in features.items()}
+
+    num_spikes = sum(len(result['indexes']) for result in results.values())
+    stages = {}
+    for entry in profiler.entries:
+        stages[entry['stage']] = {
+            'wall_time': entry['wall_time'],
+            'cpu_time': entry['cpu_time'],
+            'spikes_per_s': num_spikes / entry['wall_time'] if entry['wall_time'] > 0 else None,
+            'channel_hours_per_s': channel_hours / entry['wall_time'] if entry['wall_time'] > 0 else None,
+            'peak_rss_mb': entry['peak_rss_mb'],
+            'peak_traced_mb': entry.get('peak_traced_mb'),
+        }
+    total_wall_time = sum(stage['wall_time'] for stage in stages.values())
+
+    record = {
+        'num_channels': num_channels,
+        'duration': duration,
+        'firing_rate': firing_rate,
+        'seed': seed,
+        'gt_spikes': len(gt_sorting.to_spike_vector()),
+        'detected_spikes': num_spikes,
+        'kept_spikes': sum(int(np.sum(result['keep'])) for result in filtered_results.values()),
+        'detection_recall': detection_recall(results, gt_sorting, delta_frames=int(0.4 * sr / 1000)),
+        'stages': stages,
+        'total_wall_time': total_wall_time,
+        'spikes_per_s': num_spikes / total_wall_time if total_wall_time > 0 else None,
+        'channel_hours_per_s': channel_hours / total_wall_time if total_wall_time > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if labels is not None:
+        record.update(sorting_accuracy(results, labels, gt_sorting, delta_frames=int(0.4 * sr / 1000)))
+    return record
+
+
+def print_record(record):
+    print(f"channels={record['num_channels']} duration={record['duration']}s rate={record['firing_rate']}Hz: "
+          f"{record['detected_spikes']} spikes, recall {record['detection_recall']:.3f}"
+          + (f", accuracy {record['accuracy']:.3f}" if 'accuracy' in record else ''))
+    for name, stage in record['stages'].items():
+        traced = '' if stage['peak_traced_mb'] is None else f", peak traced {stage['peak_traced_mb']:.1f} MB"
+        print(f"    {name:<20} {stage['wall_time']:8.3f} s  {stage['spikes_per_s']:12.0f} spikes/s  "
+              f"{stage['channel_hours_per_s']:10.3f} channel-h/s{traced}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pywaveclus stages on synthetic recordings.')
+    parser.add_argument('--channels', type=int, nargs='+', default=[4, 16], help='numbers of channels')
+    parser.add_argument('--durations', type=float, nargs='+', default=[60.], help='durations in seconds')
+    parser.add_argument('--rates', type=float, nargs='+', default=[5., 20.], help='firing rates of the units in Hz')
+    parser.add_argument('--repeats', type=int, default=1, help='runs of each configuration, with seeds seed..seed+repeats-1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-clustering', action='store_true', help='skip SPC clustering and the sorting accuracy')
+    parser.add_argument('--no-trace-memory', action='store_true', help='do not track the peak allocated memory of each stage')
+    parser.add_argument('--lazy', action='store_true', help='filter the synthetic traces on the fly instead of in memory')
+    parser.add_argument('--output', help='JSON file for the results')
+    args = parser.parse_args(argv)
+
+    records = []
+    for num_channels in args.channels:
+        for duration in args.durations:
+            for firing_rate in args.rates:
+                for repeat in range(args.repeats):
+                    record = run_benchmark(num_channels, duration, firing_rate, seed=args.seed + repeat,
+                                           trace_memory=not args.no_trace_memory, clustering=not args.no_clustering,
+                                           materialize=not args.lazy)
+                    print_record(record)
+                    records.append(record)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'config': {
+                    'spike_detection': load_spike_detection_config(),
+                    'extract_waveform': load_waveform_extraction_config(),
+                    'feature_extraction': load_feature_extraction_config(),
+                    'clustering': load_clustering_config(),
+                },
+                'results': records,
+            }, output_file, indent=2)
+    return records
+
+
+if __name__ == '__main__':
+    main()
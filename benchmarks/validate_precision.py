@@ -0,0 +1,138 @@
+# validate_precision.py
+"""Validates the float32 precision mode against the float64 path on synthetic recordings.
+
+The spikes are detected once, then the waveforms, features and SPC clusters of every
+channel are computed with `precision: 'float64'` and with `precision: 'float32'`. The
+report gives, per channel, the largest waveform and feature differences (relative to the
+largest float64 value), whether the same features were selected, the cluster agreement
+(adjusted Rand index and fraction of spikes with matching labels) and the memory of the
+waveforms and features in each mode.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.validate_precision --channels 4 --duration 120 --output precision.json
+"""
+import argparse
+import json
+import time
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from sklearn.metrics import adjusted_rand_score
+from spclustering import SPC
+from pywaveclus.spike_detection import detect_spikes
+from pywaveclus.waveform_extraction import extract_waveforms_for_channel, load_waveform_extraction_config
+from pywaveclus.feature_extraction import feature_extraction
+from pywaveclus.clustering import load_clustering_config
+from .bench_pipeline import make_recordings
+
+
+def label_agreement(labels, reference):
+    """Fraction of spikes whose label matches the reference, after matching the labels one to one."""
+    labels = np.asarray(labels)
+    reference = np.asarray(reference)
+    if len(labels) == 0:
+        return 1.0
+    _, label_index = np.unique(labels, return_inverse=True)
+    _, reference_index = np.unique(reference, return_inverse=True)
+    confusion = np.zeros((label_index.max() + 1, reference_index.max() + 1), dtype=int)
+    np.add.at(confusion, (label_index, reference_index), 1)
+    rows, columns = linear_sum_assignment(-confusion)
+    return float(confusion[rows, columns].sum() / len(labels))
+
+
+def sort_with_precision(results, recording_bp2, precision, clustering=True):
+    """Extracts, featurizes and clusters every channel with the given precision.
+
+    Returns:
+        tuple: The waveforms, features, feature models (see `feature_extraction.fit_feature_model`)
+               and labels of each channel, and the time taken.
+    """
+    config = load_waveform_extraction_config()
+    dtype = np.dtype(precision)
+    chunk_duration = config.get('chunk_duration', 0) or None
+    min_clus = load_clustering_config()['min_clus']
+
+    start = time.perf_counter()
+    waveforms = {channel_id: extract_waveforms_for_channel(result, recording_bp2, channel_id, config.get('detect_method', 'neg'),
+                                                          config.get('w_pre', 20), config.get('w_post', 44),
+                                                          config.get('int_factor', 5), chunk_duration, dtype)
+                 for channel_id, result in results.items()}
+    feature_models = {}
+    features = feature_extraction(waveforms, feature_models)
+    labels = {channel_id: SPC(mintemp=0, maxtemp=0.251).fit(feature, min_clus) for channel_id, feature in features.items()} if clustering else None
+    return waveforms, features, feature_models, labels, time.perf_counter() - start
+
+
+def validate_precision(num_channels=4, duration=60., firing_rate=10., seed=0, clustering=True):
+    """Compares the float32 and float64 paths on a synthetic recording.
+
+    Returns:
+        dict: The configuration, and the comparison of each channel.
+    """
+    recording, recording_bp2, recording_bp4, _ = make_recordings(num_channels, duration, firing_rate, seed)
+    results = detect_spikes(recording, recording_bp2, recording_bp4)
+    waveforms64, features64, models64, labels64, time64 = sort_with_precision(results, recording_bp2, 'float64', clustering)
+    waveforms32, features32, models32, labels32, time32 = sort_with_precision(results, recording_bp2, 'float32', clustering)
+
+    channels = {}
+    for channel_id in results:
+        scale = np.abs(waveforms64[channel_id]).max(initial=0) or 1
+        channel = {
+            'spikes': len(waveforms64[channel_id]),
+            'waveform_max_rel_error': float(np.abs(waveforms64[channel_id] - waveforms32[channel_id]).max(initial=0) / scale),
+            'waveform_bytes': {'float64': waveforms64[channel_id].nbytes, 'float32': waveforms32[channel_id].nbytes},
+            'feature_bytes': {'float64': features64[channel_id].nbytes, 'float32': features32[channel_id].nbytes},
+        }
+        model64, model32 = models64[channel_id], models32[channel_id]
+        if model64['method'] == 'haar':
+            # The Haar coefficients (and their order) are selected by their Lilliefors statistics,
+            # which the float32 waveforms can change even when as many are selected
+            channel['same_features_selected'] = bool(np.array_equal(model64['coeff'], model32['coeff']))
+            channel['selected_coefficients'] = {'float64': model64['coeff'].tolist(), 'float32': model32['coeff'].tolist()}
+        else:
+            # PCA always keeps its first components
+            channel['same_features_selected'] = True
+        # Features are only comparable value by value when they are the same features
+        if channel['same_features_selected']:
+            feature_scale = np.abs(features64[channel_id]).max(initial=0) or 1
+            # PCA components are defined up to their sign, so compare the magnitudes
+            channel['feature_max_rel_error'] = float(np.abs(np.abs(features64[channel_id]) - np.abs(features32[channel_id])).max(initial=0) / feature_scale)
+        if clustering:
+            channel['adjusted_rand_index'] = float(adjusted_rand_score(labels64[channel_id], labels32[channel_id]))
+            channel['label_agreement'] = label_agreement(labels32[channel_id], labels64[channel_id])
+        channels[str(channel_id)] = channel
+
+    return {
+        'num_channels': num_channels,
+        'duration': duration,
+        'firing_rate': firing_rate,
+        'seed': seed,
+        'time': {'float64': time64, 'float32': time32},
+        'channels': channels,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the float32 precision mode with the float64 path.')
+    parser.add_argument('--channels', type=int, default=4, help='number of channels')
+    parser.add_argument('--duration', type=float, default=60., help='duration in seconds')
+    parser.add_argument('--rate', type=float, default=10., help='firing rate of the units in Hz')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-clustering', action='store_true', help='only compare waveforms and features')
+    parser.add_argument('--output', help='JSON file for the report')
+    args = parser.parse_args(argv)
+
+    report = validate_precision(args.channels, args.duration, args.rate, args.seed, clustering=not args.no_clustering)
+    print(f"float64 {report['time']['float64']:.2f} s, float32 {report['time']['float32']:.2f} s")
+    for channel_id, channel in report['channels'].items():
+        print(f"channel {channel_id}: {channel['spikes']} spikes, waveform error {channel['waveform_max_rel_error']:.1e}"
+              + (f", feature error {channel['feature_max_rel_error']:.1e}" if 'feature_max_rel_error' in channel else ', different features selected')
+              + (f", ARI {channel['adjusted_rand_index']:.3f}, label agreement {channel['label_agreement']:.3f}" if 'label_agreement' in channel else ''))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
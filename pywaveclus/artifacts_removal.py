@@ -1,66 +1,107 @@
-from collections import defaultdict
-
-
-def artifacts_removal(results, bundle_name,time_window=0.5):
-    
-    # Create a list to hold all spikes and their channel
-    spike_list = []
-    common_spikes_times = {}
-    # Iterate over dictionary and store all spikes in spike_list
-    for key in results:
-        for spike_time in results[key]['spikes']:
-            spike_list.append((spike_time, key))
-
-    # Sort the list by spike times
-    spike_list.sort(key=lambda x: x[0])
-
-    # Create a defaultdict to hold the spike counts for each channel in the window
-    channel_counts = defaultdict(int)
-
-    # Initialize a list to hold the spike times that occur in 6 or more channels within the time window
-    common_spikes = []
-
-    # Initialize the start of the window
-    start = 0
-
-    # Initialize a set to keep track of spike times that have already been added to common_spikes
-    added_spike_times = set()
-
-    # Iterate over the spike_list
-    for end in range(len(spike_list)):
-        # Add the channel to the channel_counts
-        channel_counts[spike_list[end][1]] += 1
-        # Check if the spike time at the end of the window is within the time window from the start of the window
-        while spike_list[end][0] - spike_list[start][0] > time_window:
-            # If it's not, move the start of the window forward
-            channel_counts[spike_list[start][1]] -= 1
-            start += 1
-        # After moving the start, check the total number of channels in the window
-        channels_in_window = [channel for channel, count in channel_counts.items() if count >= 1]
-        if len(channels_in_window) >= 6 and spike_list[end][0] not in added_spike_times:
-            # If 6 or more channels have spikes in the window and the spike time has not already been added, 
-            # add the spike time and the channels to common_spikes
-            common_spikes.append((spike_list[end][0], channels_in_window))
-            added_spike_times.add(spike_list[end][0])
-        # Convert common_spikes_times to set for faster 'in' operations
-    common_spikes_times[bundle_name] = set(spike_time for spike_time, channels in common_spikes)
-    # Create a new dictionary
-    filtered_results = {}
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def find_coincident_spikes(times, channels, time_window, min_channels=6):
+    """Finds the spikes that close a window where many channels fire together.
+
+    The spikes of all channels are merged in time order. For every spike, the window
+    holds the previous spikes that are at most `time_window` before it (and itself).
+    The spike is coincident if `min_channels` or more different channels have a spike
+    in that window.
 
-    # Loop over the results dictionary
-    for key in results:
-        spikes, indexes = results[key]['spikes'], results[key]['indexes']
-        not_common_indices = [i for i, spike in enumerate(spikes) if spike not in common_spikes_times[bundle_name]]
+    Args:
+        times (ndarray): Spike times of all channels (any unit, e.g. sample indexes).
+        channels (ndarray): Integer channel number of each spike, in 0..n_channels-1.
+        time_window (float): Window length, in the same unit as `times`.
+        min_channels (int): Number of channels needed in a window. Default is 6.
+
+    Returns:
+        ndarray: The sorted unique times of the coincident spikes.
+    """
+    order = np.argsort(times, kind='stable')
+    t = times[order]
+    c = channels[order]
+    n = len(t)
+    if n == 0:
+        return t
+
+    # Start of each spike's window: the first spike with t[end] - t[start] <= time_window.
+    # Fix up the searchsorted guess so the comparison is the exact one, also for float times.
+    end = np.arange(n)
+    start = np.searchsorted(t, t - time_window, side='left')
+    while True:
+        move_up = t - t[start] > time_window
+        move_down = (start > 0) & (t - t[np.maximum(start - 1, 0)] <= time_window)
+        if not (move_up.any() or move_down.any()):
+            break
+        start = start + move_up - move_down
+
+    # A channel is in the window if its last spike up to `end` is not before `start`
+    channels_in_window = np.zeros(n, dtype=int)
+    for channel in np.unique(c):
+        last = np.maximum.accumulate(np.where(c == channel, end, -1))
+        channels_in_window += last >= start
+
+    return np.unique(t[channels_in_window >= min_channels])
+
+
+def artifacts_keep_masks(results, time_window=0.5, sr=None, min_channels=6):
+    """Computes which spikes of a bundle are kept after artifacts removal.
+
+    Args:
+        results (dict): The spike detection results of the channels of one bundle.
+        time_window (float): Time window in milliseconds. Default is 0.5.
+        sr (float): Sampling frequency. If given, the integer 'indexes' are compared,
+                    otherwise the 'spikes' times in milliseconds.
+        min_channels (int): Number of channels that make a spike an artifact. Default is 6.
+
+    Returns:
+        tuple: A dictionary with a boolean keep-mask for each channel, and the times of the
+               common spikes (in the unit of the compared field).
+    """
+    if sr is None:
+        field, window = 'spikes', time_window
+    else:
+        field, window = 'indexes', time_window * sr / 1000
 
-        # Add new arrays to the new dictionary
+    channel_times = [np.asarray(results[key][field]) for key in results]
+    if not channel_times:
+        return {}, np.array([])
+    times = np.concatenate(channel_times)
+    channels = np.repeat(np.arange(len(channel_times)), [len(t) for t in channel_times])
+
+    common_times = find_coincident_spikes(times, channels, window, min_channels)
+    keep_masks = {key: ~np.isin(t, common_times) for key, t in zip(results, channel_times)}
+    return keep_masks, common_times
+
+
+def artifacts_removal(results, bundle_name, time_window=0.5, sr=None):
+    """Removes the spikes that occur in 6 or more channels of a bundle within the time window.
+
+    Args:
+        results (dict): The spike detection results of the channels of the bundle.
+        bundle_name (str): Name of the bundle.
+        time_window (float): Time window in milliseconds. Default is 0.5.
+        sr (float): Sampling frequency. If given, spikes are compared by sample index.
+
+    Returns:
+        tuple: The filtered results (with the keep-mask of each channel under 'keep'), and
+               a dictionary with the common spike times of the bundle.
+    """
+    keep_masks, common_times = artifacts_keep_masks(results, time_window, sr)
+
+    filtered_results = {}
+    for key, keep in keep_masks.items():
         filtered_results[key] = {
-            'spikes': spikes[not_common_indices],
-            'indexes': indexes[not_common_indices],
+            'spikes': np.asarray(results[key]['spikes'])[keep],
+            'indexes': np.asarray(results[key]['indexes'])[keep],
+            'keep': keep,
         }
-    return filtered_results, common_spikes_times
+    return filtered_results, {bundle_name: common_times}
 
 
-def artifacts_removal_for_bundle(results,bundle_dict):
+def artifacts_removal_for_bundle(results, bundle_dict, time_window=0.5, sr=None):
     """
     Perform artifacts removal for each bundle in the results.
 
@@ -68,36 +109,38 @@ def artifacts_removal_for_bundle(results,bundle_dict):
         bundle_dict (dict): A dictionary with bundle names as keys and their corresponding channel information as values.
                            Example: {'mLAMY': [{'channel_id': 257, 'label': 'mLAMY01 raw'}]}
         results (dict): A dictionary containing the spike detection results for each channel.
-        time_window (float): Time window in seconds to consider for artifacts removal. Default is 0.5 seconds.
+        time_window (float): Time window in milliseconds to consider for artifacts removal. Default is 0.5.
+        sr (float): Sampling frequency. If given, spikes are compared by their integer sample index.
 
     Returns:
-        dict: A dictionary containing the filtered spike detection results after artifacts removal for each bundle.
+        tuple: A dictionary containing the filtered spike detection results after artifacts removal for each bundle,
+               and a dictionary with the common spike times of each bundle.
     """
 
-    # Create a dictionary to hold the results after artifacts removal for each bundle
-    filtered_results_for_bundle = {}
-    common_spikes = {}
-
-    for bundle_name, channel_info_list in bundle_dict.items():
-        # Create a new dictionary for this bundle
-        bundle_results = {}
-
+    def process_bundle(bundle_name, channel_info_list):
         # Filter the results for channels in the current bundle
         bundle_channels = [info['channel_id'] for info in channel_info_list]
-        if len(bundle_channels)<=6:
-            return results
-        
-        #bundle_results = {channel_id: results[channel_id] for channel_id in bundle_channels if channel_id in results}
-        import copy
-
-        # Inside the loop
-        bundle_results = {channel_id: copy.deepcopy(results[channel_id]) for channel_id in bundle_channels if channel_id in results}
-
-        # Perform artifacts removal for this bundle's results
-        filtered_bundle_results,common_spikes_times = artifacts_removal(bundle_results, bundle_name)
-
-        # Update the filtered results for the bundle
-        filtered_results_for_bundle.update(filtered_bundle_results)
-        common_spikes.update(common_spikes_times)
-    
-    return filtered_results_for_bundle,common_spikes
+        bundle_results = {channel_id: results[channel_id] for channel_id in bundle_channels if channel_id in results}
+
+        # Bundles with too few channels have no artifacts to remove
+        if len(bundle_channels) <= 6:
+            bundle_results = {channel_id: dict(result, keep=np.ones(len(result['indexes']), dtype=bool))
+                              for channel_id, result in bundle_results.items()}
+            return bundle_results, {bundle_name: np.array([])}
+
+        return artifacts_removal(bundle_results, bundle_name, time_window, sr)
+
+    # Bundles are independent, so process them in parallel
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(process_bundle, bundle_name, channel_info_list)
+                   for bundle_name, channel_info_list in bundle_dict.items()]
+
+        # Create a dictionary to hold the results after artifacts removal for each bundle
+        filtered_results_for_bundle = {}
+        common_spikes = {}
+        for future in futures:
+            filtered_bundle_results, common_spikes_times = future.result()
+            filtered_results_for_bundle.update(filtered_bundle_results)
+            common_spikes.update(common_spikes_times)
+
+    return filtered_results_for_bundle, common_spikes
@@ -0,0 +1,199 @@
+# batch.py
+"""Resumable batch runner of the spike sorting pipeline over several recordings.
+
+The recordings and their bundles are listed in a YAML (or JSON) manifest:
+
+    output_dir: /data/sorted        # save_dir of a recording defaults to <output_dir>/<name>
+    artifact_removal: True          # defaults of every recording, which can override them
+    fused: False
+    freq_min: 300                   # bandpass of the bp2 and bp4 recordings
+    freq_max: 3000
+    recordings:
+      - name: session1
+        path: /data/session1        # loaded with spikeinterface.core.load
+        bundles:
+          A: [0, 1, 2, 3, 4, 5, 6, 7]
+      - name: session2
+        path: /data/session2.rhd
+        reader: read_intan          # or read with a function of spikeinterface.extractors
+        reader_kwargs: {stream_id: '0'}
+        save_dir: /data/other
+
+A recording without bundles is sorted as a single bundle of all its channels. With
+artifacts removal, each bundle is a task, since artifacts are found across its channels;
+without it, each channel is a task. Tasks of a recording share its save_dir, so each task
+saves its report as `pipeline_report_<task>.json` (e.g. `pipeline_report_bundle_A.json` or
+`pipeline_report_channel_3.json`), and the temperature plot grid of a channel task is named
+after the channel (`bundle_A_channel_3.png`). Tasks run in worker processes, and when a task ends,
+an empty marker `<save_dir>/completed/channel_<id>.done` is written for each of its
+channels. A rerun skips the tasks whose channels all have a marker, so a crashed or killed
+batch resumes where it stopped.
+
+Run it as `pywaveclus-batch manifest.yaml --workers 4`, or `python main.py manifest.yaml`.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import yaml
+
+
+def load_manifest(manifest_file):
+    with open(manifest_file, 'r') as manifest:
+        return yaml.safe_load(manifest)
+
+
+def marker_path(save_dir, channel_id):
+    return os.path.join(save_dir, 'completed', f'channel_{channel_id}.done')
+
+
+def is_completed(save_dir, channel_id):
+    return os.path.exists(marker_path(save_dir, channel_id))
+
+
+def mark_completed(save_dir, channel_ids):
+    """Writes the completion marker of each channel."""
+    os.makedirs(os.path.join(save_dir, 'completed'), exist_ok=True)
+    for channel_id in channel_ids:
+        open(marker_path(save_dir, channel_id), 'w').close()
+
+
+def load_recording(entry):
+    """Loads the recording of a manifest entry, with its `reader` or `spikeinterface.core.load`."""
+    if entry.get('reader'):
+        import spikeinterface.extractors as se
+        return getattr(se, entry['reader'])(entry['path'], **entry.get('reader_kwargs', {}))
+    from spikeinterface.core import load
+    return load(entry['path'])
+
+
+def recording_tasks(entry, defaults, channel_ids):
+    """Splits a manifest entry into tasks, each a bundle (with artifacts removal) or a channel.
+
+    Args:
+        entry (dict): The manifest entry of the recording.
+        defaults (dict): The top-level settings of the manifest.
+        channel_ids (list): The channel ids of the recording.
+
+    Returns:
+        list: The tasks, each a dictionary with what `run_task` needs.
+    """
+    settings = {name: entry.get(name, defaults.get(name, default))
+                for name, default in (('artifact_removal', True), ('fused', False), ('freq_min', 300), ('freq_max', 3000))}
+    save_dir = entry.get('save_dir') or os.path.join(defaults.get('output_dir', '.'), entry['name'])
+    # Manifest channel ids are matched to the recording's, which may be strings
+    ids_by_name = {str(channel_id): channel_id for channel_id in channel_ids}
+    bundles = entry.get('bundles') or {'all': list(channel_ids)}
+    bundle_dict = {bundle_name: [ids_by_name[str(channel_id)] for channel_id in bundle_channels]
+                   for bundle_name, bundle_channels in bundles.items()}
+
+    # Each task gets its own name, which its report and plot grid are saved under
+    if settings['artifact_removal']:
+        groups = [(bundle_name, f'bundle_{bundle_name}', bundle_channels) for bundle_name, bundle_channels in bundle_dict.items()]
+    else:
+        groups = [(f'{bundle_name}_channel_{channel_id}', f'channel_{channel_id}', [channel_id])
+                  for bundle_name, bundle_channels in bundle_dict.items() for channel_id in bundle_channels]
+    return [dict(settings, recording=entry, name=entry['name'], save_dir=save_dir, bundle_name=bundle_name, task_name=task_name,
+                 channel_ids=group_channels)
+            for bundle_name, task_name, group_channels in groups]
+
+
+def run_task(task):
+    """Sorts the channels of one task and marks them completed.
+
+    Returns:
+        dict: The channels, recorded duration (s), spikes and wall time of the task.
+    """
+    # Imported here so the manifest can be read without loading the whole pipeline
+    from spikeinterface.preprocessing import bandpass_filter
+    from .waveclus import spike_sorting_pipeline
+
+    start = time.perf_counter()
+    recording = load_recording(task['recording']).select_channels(task['channel_ids'])
+    recording_bp2 = bandpass_filter(recording, freq_min=task['freq_min'], freq_max=task['freq_max'], filter_order=2)
+    recording_bp4 = bandpass_filter(recording, freq_min=task['freq_min'], freq_max=task['freq_max'], filter_order=4)
+    bundle_dict = {task['bundle_name']: [{'channel_id': channel_id} for channel_id in task['channel_ids']]}
+
+    report = spike_sorting_pipeline(recording, recording_bp2, recording_bp4, bundle_dict,
+                                    artifact_removal=task['artifact_removal'], save_dir=task['save_dir'], fused=task['fused'],
+                                    run_name=task['task_name'])
+    mark_completed(task['save_dir'], task['channel_ids'])
+
+    stages = report['stages']
+    detection = stages.get('detect_and_extract_waveforms') or stages.get('detect_spikes') or {}
+    duration = sum(recording.get_num_samples(segment_index) for segment_index in range(recording.get_num_segments())) / recording.get_sampling_frequency()
+    return {
+        'channels': len(task['channel_ids']),
+        'duration': duration,
+        'spikes': detection.get('spikes', 0),
+        'wall_time': time.perf_counter() - start,
+    }
+
+
+def run_batch(manifest, workers=1, redo=False):
+    """Runs every pending task of a manifest in `workers` processes.
+
+    Args:
+        manifest (dict): The loaded manifest.
+        workers (int): Number of worker processes, 0 for one per CPU.
+        redo (bool): Whether to sort the completed channels again.
+
+    Returns:
+        dict: The throughput summary of the batch.
+    """
+    start = time.perf_counter()
+    tasks = []
+    skipped_channels = 0
+    for entry in manifest['recordings']:
+        channel_ids = list(load_recording(entry).get_channel_ids())
+        for task in recording_tasks(entry, manifest, channel_ids):
+            if not redo and all(is_completed(task['save_dir'], channel_id) for channel_id in task['channel_ids']):
+                skipped_channels += len(task['channel_ids'])
+            else:
+                tasks.append(task)
+    print(f'{len(tasks)} tasks to run, {skipped_channels} channels already completed')
+
+    summary = {'tasks': len(tasks), 'failed': 0, 'channels': 0, 'skipped_channels': skipped_channels,
+               'channel_hours': 0.0, 'spikes': 0}
+    with ProcessPoolExecutor(max_workers=workers if workers > 0 else os.cpu_count()) as executor:
+        futures = {executor.submit(run_task, task): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            task_channels = ', '.join(str(channel_id) for channel_id in task['channel_ids'])
+            try:
+                stats = future.result()
+            except Exception as error:
+                summary['failed'] += 1
+                print(f"{task['name']} {task['task_name']} ({task_channels}) failed: {error!r}")
+                continue
+            summary['channels'] += stats['channels']
+            summary['channel_hours'] += stats['channels'] * stats['duration'] / 3600
+            summary['spikes'] += stats['spikes']
+            print(f"{task['name']} {task['task_name']} ({task_channels}): {stats['spikes']} spikes in {stats['wall_time']:.1f} s")
+
+    summary['wall_time'] = time.perf_counter() - start
+    return summary
+
+
+def print_summary(summary):
+    wall_time = summary['wall_time'] or 1e-9
+    print(f"{summary['tasks'] - summary['failed']} of {summary['tasks']} tasks done ({summary['failed']} failed), "
+          f"{summary['channels']} channels sorted, {summary['skipped_channels']} skipped as completed")
+    print(f"{summary['channel_hours']:.2f} channel-hours and {summary['spikes']} spikes in {summary['wall_time']:.1f} s: "
+          f"{summary['channel_hours'] * 3600 / wall_time:.1f} channel-seconds/s, {summary['spikes'] / wall_time:.0f} spikes/s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sort the recordings of a manifest, resuming the channels not completed yet.')
+    parser.add_argument('manifest', help='YAML or JSON manifest of the recordings and their bundles')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, 0 for one per CPU')
+    parser.add_argument('--redo', action='store_true', help='sort the completed channels again')
+    args = parser.parse_args(argv)
+
+    summary = run_batch(load_manifest(args.manifest), workers=args.workers, redo=args.redo)
+    print_summary(summary)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
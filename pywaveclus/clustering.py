@@ -1,6 +1,7 @@
 # clustering.py
 # spclustering: Super Paramagnetic Clustering Wrapper
-from spclustering import SPC, plot_temperature_plot
+from spclustering import SPC
+import numpy as np
 import yaml
 import os
 
@@ -10,10 +11,27 @@ def load_clustering_config():
         config = yaml.safe_load(config_file)
         return config['clustering']
 
-def SPC_clustering(features):
+def SPC_clustering(features, plotter=None, profiler=None):
+    """Clusters the features of each channel with SPC.
+
+    If `max_spk` is set in the clustering config and a channel has more spikes, only
+    `max_spk` of them (chosen as set by `subsample`) are clustered with SPC, and the others
+    are assigned to the nearest cluster template, as Wave_clus does, with `min_clus` scaled
+    down by the subsampled fraction. The number of spikes assigned this way is stored as
+    'forced' in the metadata of the channel, and logged with `profiler` (an
+    `instrumentation.PipelineProfiler`) if one is given.
+
+    With `plot_temperature` set, the metadata of each channel is queued to `plotter` (a
+    `temperature_plots.TemperaturePlotter`), which renders the plot in the background while
+    clustering continues.
+
+    Returns:
+        tuple: The labels and the SPC metadata of each channel.
+    """
     config = load_clustering_config()
     min_clus = config['min_clus']
     plot_temperature = config['plot_temperature']
+    max_spk = config.get('max_spk', 0)
 
     clustering = SPC(mintemp=0, maxtemp=0.251)
 
@@ -21,11 +39,83 @@ def SPC_clustering(features):
     metadata = {}
 
     for channel_id, feature in features.items():
-        label, metadata[channel_id] = clustering.fit(feature, min_clus, return_metadata=True)
+        if max_spk and len(feature) > max_spk:
+            clustered = subsample_spikes(len(feature), max_spk, config.get('subsample', 'random'), config.get('subsample_seed', 0))
+            # Scale min_clus so clusters need the same fraction of the spikes as without subsampling
+            subsample_min_clus = max(1, round(min_clus * len(clustered) / len(feature)))
+            clustered_label, metadata[channel_id] = clustering.fit(feature[clustered], subsample_min_clus, return_metadata=True)
+            label = assign_to_templates(feature, *cluster_templates(feature[clustered], clustered_label), config.get('template_sdnum', 3))
+            label[clustered] = clustered_label
+            metadata[channel_id]['forced'] = int(np.count_nonzero(label) - np.count_nonzero(clustered_label))
+            if profiler is not None:
+                profiler.log(f'channel {channel_id}: {len(clustered)} of {len(feature)} spikes clustered, '
+                             f'{metadata[channel_id]["forced"]} others assigned to the clusters')
+        else:
+            label, metadata[channel_id] = clustering.fit(feature, min_clus, return_metadata=True)
         labels[channel_id] = label
 
-        if plot_temperature:
-            plot_temperature_plot(metadata[channel_id])
-            
+        if plot_temperature and plotter is not None:
+            plotter.submit(channel_id, metadata[channel_id])
 
     return labels, metadata
+
+
+def subsample_spikes(nspk, max_spk, method='random', seed=0):
+    """Chooses `max_spk` of `nspk` spikes to cluster.
+
+    Args:
+        nspk (int): Number of spikes of the channel.
+        max_spk (int): Number of spikes to choose.
+        method (str): 'random' for a random subset, 'stratified' for spikes evenly spaced in
+                      time, which keeps the proportion of every part of the recording.
+        seed (int): Seed of the random subset.
+
+    Returns:
+        ndarray: The sorted indexes of the chosen spikes.
+    """
+    if method == 'random':
+        return np.sort(np.random.default_rng(seed).choice(nspk, max_spk, replace=False))
+    elif method == 'stratified':
+        return np.unique(np.linspace(0, nspk - 1, max_spk).round().astype(int))
+    raise ValueError(f"Invalid value {method} for argument 'subsample'. Must be 'random' or 'stratified'.")
+
+
+def cluster_templates(features, labels):
+    """Computes the center and spread of each cluster, as Wave_clus's template matching.
+
+    Args:
+        features (ndarray): Features of the clustered spikes, of shape (nspk, nfeatures).
+        labels (ndarray): Cluster label of each spike, 0 for the unassigned ones.
+
+    Returns:
+        tuple: The cluster labels, the centers (mean features) of the clusters and their
+               spread, the square root of the summed feature variances.
+    """
+    features = np.asarray(features)
+    labels = np.asarray(labels)
+    cluster_labels = np.unique(labels[labels != 0])
+    centers = np.array([features[labels == label].mean(axis=0) for label in cluster_labels]).reshape(len(cluster_labels), features.shape[1])
+    spreads = np.array([np.sqrt(features[labels == label].var(axis=0).sum()) for label in cluster_labels])
+    return cluster_labels, centers, spreads
+
+
+def assign_to_templates(features, cluster_labels, centers, spreads, template_sdnum=3, batch_size=8192):
+    """Assigns spikes to the nearest cluster center within `template_sdnum` spreads of it.
+
+    Returns:
+        ndarray: The label of the nearest conforming cluster of each spike, 0 if there is none.
+    """
+    features = np.asarray(features)
+    assigned = np.zeros(len(features), dtype=int)
+    if len(cluster_labels) == 0:
+        return assigned
+
+    max_distances = template_sdnum * np.asarray(spreads)
+    for start in range(0, len(features), batch_size):
+        batch = features[start:start + batch_size]
+        distances = np.sqrt(((batch[:, np.newaxis, :] - centers[np.newaxis, :, :]) ** 2).sum(axis=2))
+        distances[distances >= max_distances] = np.inf
+        nearest = distances.argmin(axis=1)
+        conforming = np.isfinite(distances[np.arange(len(batch)), nearest])
+        assigned[start:start + batch_size] = np.where(conforming, np.asarray(cluster_labels)[nearest], 0)
+    return assigned
@@ -0,0 +1,127 @@
+# columnar_output.py
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.io as sio
+import yaml
+from .spike_table import cluster_class_labels
+
+
+def load_output_config():
+    file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+    with open(file_path, 'r') as config_file:
+        return yaml.safe_load(config_file)
+
+
+def channel_output_dir(save_dir, channel_id, artifact_removal=False):
+    """Returns the folder of a channel, next to where its .mat file would be saved."""
+    if artifact_removal:
+        save_dir = os.path.join(save_dir, 'sorting')
+    else:
+        save_dir = os.path.join(save_dir, 'sorting', 'waveclus', 'output')
+    return os.path.join(save_dir, f'channel_{channel_id}_data')
+
+
+def save_channel_data_to_npy(recording, channel_id, spike_detection_results, waveforms, features, labels, save_dir, filtered_results=None):
+    """
+    Save data for a channel as a folder of .npy files, one per column.
+
+    Each array is stored once, so `spikes` and `inspk` can be memory-mapped when read back
+    with `load_channel_data`. `cluster_class.mat` holds the (label, spike time) pairs and the
+    parameters for MATLAB consumers.
+
+    Parameters:
+        recording: The recording, used for its sampling frequency.
+        channel_id (int): ID of the current channel.
+        spike_detection_results (dict): Dictionary containing spike detection results.
+        waveforms (dict): Dictionary containing the waveforms of all detected spikes.
+        features (dict): Dictionary containing feature data.
+        labels (dict): Dictionary containing clustering labels.
+        save_dir (str): Output folder.
+        filtered_results (dict): The results after artifacts removal, if it was done. Features and labels
+                                 then only cover the kept spikes, which are flagged in `keep.npy`.
+
+    Returns:
+        str: The folder of the channel.
+    """
+    result = spike_detection_results[channel_id]
+    spike_times = np.asarray(result['spikes'])
+    channel_labels = np.asarray(labels[channel_id])
+
+    if filtered_results is None:
+        keep = np.ones(len(spike_times), dtype=bool)
+        class_labels = cluster_class_labels(channel_labels)
+    else:
+        keep = np.asarray(filtered_results[channel_id]['keep'])
+        # Spikes removed as artifacts get label 500, unassigned kept spikes 1000
+        class_labels = cluster_class_labels(channel_labels, keep, unassigned=1000)
+
+    config = load_output_config()
+    config['sr'] = recording.get_sampling_frequency()
+
+    folder = channel_output_dir(save_dir, channel_id, artifact_removal=filtered_results is not None)
+    os.makedirs(folder, exist_ok=True)
+    columns = {
+        'spike_times': spike_times,
+        'indexes': np.asarray(result['indexes']),
+        'spikes': np.asarray(waveforms[channel_id]),
+        'keep': keep,
+        'inspk': np.asarray(features[channel_id]),
+        'labels': channel_labels,
+        'cluster_class': np.column_stack([class_labels, spike_times]),
+    }
+    for name, column in columns.items():
+        np.save(os.path.join(folder, f'{name}.npy'), column)
+    with open(os.path.join(folder, 'par.json'), 'w') as par_file:
+        json.dump(config, par_file, indent=2)
+    sio.savemat(os.path.join(folder, 'cluster_class.mat'), {'cluster_class': columns['cluster_class'], 'par': config})
+
+    print(f"Data for channel {channel_id} saved to {folder}")
+    return folder
+
+
+def save_channels_to_npy(recording, spike_detection_results, waveforms, features, labels, save_dir, filtered_results=None, max_workers=None):
+    """Saves every channel in `labels` with `save_channel_data_to_npy`, writing channels in parallel."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(save_channel_data_to_npy, recording, channel_id, spike_detection_results, waveforms,
+                                   features, labels, save_dir, filtered_results)
+                   for channel_id in labels.keys()]
+        return [future.result() for future in futures]
+
+
+class ChannelData:
+    """Lazy reader of a channel folder written by `save_channel_data_to_npy`.
+
+    Columns are loaded on first access, memory-mapped, e.g. `data['spikes']` or `data.inspk`.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def keys(self):
+        return sorted(file_name[:-len('.npy')] for file_name in os.listdir(self.folder) if file_name.endswith('.npy'))
+
+    def __getitem__(self, name):
+        path = os.path.join(self.folder, f'{name}.npy')
+        if not os.path.exists(path):
+            raise KeyError(name)
+        return np.load(path, mmap_mode='r')
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'folder':
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    @property
+    def par(self):
+        with open(os.path.join(self.folder, 'par.json'), 'r') as par_file:
+            return json.load(par_file)
+
+
+def load_channel_data(save_dir, channel_id, artifact_removal=False):
+    """Returns a lazy `ChannelData` reader of a channel saved in `save_dir`."""
+    return ChannelData(channel_output_dir(save_dir, channel_id, artifact_removal))
@@ -1,8 +1,8 @@
 # feature_extraction.py
 import numpy as np
 import pywt
-from sklearn.decomposition import PCA
-from statsmodels.stats.diagnostic import lilliefors
+from sklearn.decomposition import PCA, IncrementalPCA
+from scipy.special import ndtr
 import yaml
 import os 
 
@@ -19,30 +19,75 @@ def haar_feature_extraction(spikes, level=4, ls=20+44, max_inputs=np.ceil(0.75 *
         features[channel] = haar_feature_extraction_for_channel(spike_waveforms, level, ls, max_inputs, min_inputs, nd)
     return features
 
+def lilliefors_statistics(cc):
+    """Computes the Lilliefors (KS against a fitted normal) statistic of every column.
+
+    Values further than 3 standard deviations from the column mean are left out, and
+    columns with 10 or fewer remaining values get 0. All columns are computed at once,
+    matching `statsmodels.stats.diagnostic.lilliefors(aux, dist='norm')[0]` per column.
+
+    Args:
+        cc (ndarray): Array of shape (nspk, ncoeff).
+
+    Returns:
+        ndarray: The statistic of each column.
+    """
+    nspk = cc.shape[0]
+    thr_dist = np.std(cc, axis=0) * 3
+    mean = np.mean(cc, axis=0)
+    inliers = (cc > mean - thr_dist) & (cc < mean + thr_dist)
+    n = inliers.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        aux = np.where(inliers, cc, 0)
+        aux_mean = aux.sum(axis=0) / n
+        aux_std = np.sqrt((np.where(inliers, cc - aux_mean, 0) ** 2).sum(axis=0) / (n - 1))
+        # Outliers are sorted after the inliers and ignored below
+        z = np.sort(np.where(inliers, (cc - aux_mean) / aux_std, np.inf), axis=0)
+        cdfvals = ndtr(z)
+        rank = np.arange(1, nspk + 1)[:, np.newaxis]
+        valid = rank <= n
+        dplus = np.where(valid, rank / n - cdfvals, -np.inf).max(axis=0, initial=-np.inf)
+        dminus = np.where(valid, cdfvals - (rank - 1) / n, -np.inf).max(axis=0, initial=-np.inf)
+
+    return np.where(n > 10, np.maximum(dplus, dminus), 0)
+
+
 def haar_feature_extraction_for_channel(spikes, level, ls, max_inputs, min_inputs, nd):
+    return fit_haar(spikes, level, ls, max_inputs, min_inputs, nd)[0]
+
+
+def fit_haar(spikes, level, ls, max_inputs, min_inputs, nd):
+    """Returns the Haar features of one channel and the indexes of the selected coefficients."""
+    cc = haar_coefficients(spikes, level, ls)
+    coeff = select_haar_coefficients(cc, max_inputs, min_inputs, nd)
+    return cc[:, coeff], coeff
+
+
+def haar_coefficients(spikes, level, ls):
+    """Returns the Haar wavelet coefficients of each spike, as an array of shape (nspk, ls).
+
+    The coefficients are float32 for float32 spikes, and float64 otherwise.
+    """
+    spikes = np.asarray(spikes)
     nspk = len(spikes)
     # Determine the number of coefficients based on the desired level and the length of the original data
     # Create a 2D array 'cc' to store the wavelet coefficients for each spike
-    cc = np.zeros((nspk, ls))
+    cc = np.zeros((nspk, ls), dtype=np.float32 if spikes.dtype == np.float32 else np.float64)
 
-    for i in range(nspk):
-        c = pywt.wavedec(spikes[i], 'haar', level=level)
-        flattened_coeffs = np.hstack(c)[:ls]
-        cc[i, :len(flattened_coeffs)] = flattened_coeffs
-        
-    ls = cc.shape[1]      
-    ks = np.zeros(ls)
+    c = pywt.wavedec(spikes, 'haar', level=level, axis=1)
+    flattened_coeffs = np.hstack(c)[:, :ls]
+    cc[:, :flattened_coeffs.shape[1]] = flattened_coeffs
+    return cc
 
-    for i in range(ls):
-        thr_dist = np.std(cc[:, i]) * 3
-        thr_dist_min = np.mean(cc[:, i]) - thr_dist
-        thr_dist_max = np.mean(cc[:, i]) + thr_dist
-        aux = cc[(cc[:, i] > thr_dist_min) & (cc[:, i] < thr_dist_max), i]
 
-        if len(aux) > 10:
-            ks[i] = lilliefors(aux, dist='norm', pvalmethod='table')[0]
-        else:
-            ks[i] = 0
+def select_haar_coefficients(cc, max_inputs, min_inputs, nd):
+    """Selects the least normally distributed Haar coefficients (by Lilliefors statistic).
+
+    Returns:
+        ndarray: The column indexes of the selected coefficients in `cc`.
+    """
+    ks = lilliefors_statistics(cc)
 
     sorted_indices = np.argsort(ks)
     ind = sorted_indices[::]
@@ -52,15 +97,22 @@ def haar_feature_extraction_for_channel(spikes, level, ls, max_inputs, min_input
     d = ((A[nd-1:] - A[:-nd+1]) / maxA) * (ncoeff / nd)
     all_above1 = np.where(d >= 1)[0]
     
-    if len(all_above1) >= 2:
+    # The smoothed differences keep len(all_above1) - 3 values, so with fewer than 4 values
+    # over 1 there are none to find a knee in (indexing them raised IndexError)
+    if len(all_above1) >= 4:
         aux2 = np.diff(all_above1)
         temp_bla = np.convolve(aux2, np.array([1, 1, 1]) / 3)
         temp_bla = temp_bla[1:len(aux2)-1]
         temp_bla[0] = aux2[0]
         temp_bla[-1] = aux2[-1]
 
-        thr_knee_diff = all_above1[np.where(temp_bla[1:] == 1)[0][0]] + (nd / 2)
-        inputs = max_inputs - thr_knee_diff 
+        knee = np.where(temp_bla[1:] == 1)[0]
+        if len(knee) > 0:
+            thr_knee_diff = all_above1[knee[0]] + (nd / 2)
+            inputs = max_inputs - thr_knee_diff
+        else:
+            # No knee found, as in Wave_clus fall back to the minimum number of inputs
+            inputs = min_inputs
     else:
         inputs = min_inputs
 
@@ -69,52 +121,131 @@ def haar_feature_extraction_for_channel(spikes, level, ls, max_inputs, min_input
     elif inputs < min_inputs:
         inputs = min_inputs
         
-    coeff = ind[-int(inputs):]
-    inspk = np.zeros((nspk, int(inputs)))
-
-    for i in range(nspk):
-        for j in range(int(inputs)):
-            inspk[i, j] = cc[i, coeff[j]]
-
-    return inspk
+    return ind[-int(inputs):]
 
 
-def pca_feature_extraction(spikes, n_components):
+def pca_feature_extraction(spikes, n_components, solver='full', batch_size=65536):
     features = {}
     for channel, spike_waveforms in spikes.items():
-        features[channel] = pca_feature_extraction_for_channel(spike_waveforms, n_components)
+        features[channel] = pca_feature_extraction_for_channel(spike_waveforms, n_components, solver, batch_size)
     return features
 
-def pca_feature_extraction_for_channel(spikes, n_components=10):
-    nspk = spikes.shape[0]
+def pca_feature_extraction_for_channel(spikes, n_components=10, solver='full', batch_size=65536):
+    return fit_pca(spikes, n_components, solver, batch_size)[0]
+
+
+def fit_pca(spikes, n_components=10, solver='full', batch_size=65536):
+    """Returns the PCA features of one channel, with the mean and components they are projected on."""
+    if solver != 'full':
+        mean, components = fit_streaming_pca(spikes, n_components, solver, batch_size)
+        return project_pca(spikes, mean, components, batch_size), mean, components
+
     pca = PCA(n_components=n_components)
-    S = pca.fit_transform(spikes)
-    C = pca.components_
-    cc_pca = S
-    coeff_pca = np.arange(0, S.shape[1] + 1)
-    inputs = n_components
-    inspk_pca = np.zeros((nspk, inputs))
+    return pca.fit_transform(spikes), pca.mean_, pca.components_
+
+
+def spike_batches(spikes, batch_size, min_size=1):
+    """Yields consecutive batches of rows of `spikes`, read one at a time.
+
+    `spikes` can be any array-like with slicing and a length, e.g. an ndarray, a memory-mapped
+    .npy file (see `columnar_output.ChannelData`) or a `WaveformStore`. A last batch shorter
+    than `min_size` is joined to the previous one.
+    """
+    nspk = len(spikes)
+    starts = list(range(0, nspk, batch_size))
+    if len(starts) > 1 and nspk - starts[-1] < min_size:
+        starts.pop()
+    for start, end in zip(starts, starts[1:] + [nspk]):
+        yield np.asarray(spikes[start:end])
+
+
+def fit_streaming_pca(spikes, n_components, solver='incremental', batch_size=65536, seed=0):
+    """Fits a PCA of the spikes of one channel without loading all of them at once.
+
+    With solver 'incremental', an IncrementalPCA is fitted on consecutive batches of
+    `batch_size` spikes. With solver 'randomized', a randomized PCA is fitted on `batch_size`
+    spikes drawn at random, with a fixed seed.
+
+    Returns:
+        tuple: The mean of the spikes and the principal components, of shape (n_components, ls).
+    """
+    nspk = len(spikes)
+    if solver == 'incremental':
+        pca = IncrementalPCA(n_components=n_components)
+        # partial_fit needs at least n_components spikes per batch
+        for batch in spike_batches(spikes, max(batch_size, n_components), n_components):
+            pca.partial_fit(batch)
+    elif solver == 'randomized':
+        indexes = np.arange(nspk)
+        if nspk > batch_size:
+            indexes = np.sort(np.random.default_rng(seed).choice(nspk, batch_size, replace=False))
+        pca = PCA(n_components=n_components, svd_solver='randomized', random_state=seed)
+        pca.fit(np.asarray(spikes[indexes]))
+    else:
+        raise ValueError(f"Invalid value {solver} for argument 'pca_solver'. Must be 'full', 'incremental' or 'randomized'.")
+    return pca.mean_, pca.components_
+
+
+def project_pca(spikes, mean, components, batch_size=65536):
+    """Projects the spikes on the principal components, `batch_size` spikes at a time."""
+    dtype = np.float32 if getattr(spikes, 'dtype', None) == np.float32 else np.float64
+    mean = mean.astype(dtype, copy=False)
+    components = components.astype(dtype, copy=False)
+    features = np.empty((len(spikes), len(components)), dtype=dtype)
+    start = 0
+    for batch in spike_batches(spikes, batch_size):
+        features[start:start + len(batch)] = (batch - mean) @ components.T
+        start += len(batch)
+    return features
 
-    for i in range(nspk):
-        for j in range(inputs):
-            inspk_pca[i, j] = cc_pca[i, coeff_pca[j]]
+def feature_extraction(waveforms, models=None):
+    """Extracts the features of the waveforms of each channel, with the method of the config.
 
-    return inspk_pca
+    Args:
+        waveforms (dict): The waveforms of each channel.
+        models (dict): Optional dictionary in which the feature model of each channel (see
+                       `fit_feature_model`) is stored, to project new spikes on the same features.
 
-def feature_extraction(waveforms):
+    Returns:
+        dict: The features of each channel.
+    """
     config = load_feature_extraction_config()
+    features = {}
+    for channel, spike_waveforms in waveforms.items():
+        features[channel], model = fit_feature_model(spike_waveforms, config)
+        if models is not None:
+            models[channel] = model
+    return features
+
+
+def fit_feature_model(spikes, config=None):
+    """Extracts the features of one channel with the method of the config, and keeps how.
+
+    Returns:
+        tuple: The features, and a dictionary with what `project_features` needs to compute
+               the same features for new spikes: the selected Haar coefficient indexes for
+               'haar', or the mean and components of the fitted PCA for 'pca'.
+    """
+    if config is None:
+        config = load_feature_extraction_config()
     method = config['method']
 
     if method == 'haar':
-        level = config['haar_level']
-        ls = config['haar_ls']
-        max_inputs = config['haar_max_inputs']
-        min_inputs = config['haar_min_inputs']
-        nd = config['haar_nd']
-        return haar_feature_extraction(waveforms, level, ls, max_inputs, min_inputs, nd)
-        
+        inspk, coeff = fit_haar(spikes, config['haar_level'], config['haar_ls'], config['haar_max_inputs'],
+                                config['haar_min_inputs'], config['haar_nd'])
+        return inspk, {'method': 'haar', 'level': config['haar_level'], 'ls': config['haar_ls'], 'coeff': coeff}
     elif method == 'pca':
-        n_components = config['pca_n_components']
-        return pca_feature_extraction(waveforms, n_components)
+        inspk, mean, components = fit_pca(spikes, config['pca_n_components'], config.get('pca_solver', 'full'),
+                                          config.get('pca_batch_size', 65536))
+        return inspk, {'method': 'pca', 'mean': mean, 'components': components}
     else:
-        raise ValueError(f"Invalid value {method} for argument 'method'. Must be 'haar' or 'pca'.")
\ No newline at end of file
+        raise ValueError(f"Invalid value {method} for argument 'method'. Must be 'haar' or 'pca'.")
+
+
+def project_features(spikes, model):
+    """Computes the features of new spikes with a model returned by `fit_feature_model`."""
+    if model['method'] == 'haar':
+        return haar_coefficients(spikes, int(model['level']), int(model['ls']))[:, model['coeff']]
+    elif model['method'] == 'pca':
+        return project_pca(spikes, model['mean'], model['components'])
+    raise ValueError(f"Invalid value {model['method']} for argument 'method'. Must be 'haar' or 'pca'.")
@@ -0,0 +1,201 @@
+# incremental.py
+import json
+import os
+import numpy as np
+import yaml
+from .spike_detection import detect_spikes, load_spike_detection_config
+from .artifacts_removal import artifacts_removal_for_bundle
+from .waveform_extraction import extract_waveforms
+from .feature_extraction import project_features
+from .clustering import SPC_clustering, load_clustering_config, cluster_templates, assign_to_templates
+from .instrumentation import PipelineProfiler
+
+
+def load_incremental_config():
+    file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+    with open(file_path, 'r') as config_file:
+        config = yaml.safe_load(config_file)
+        return config['incremental']
+
+
+def model_path(save_dir, channel_id):
+    return os.path.join(save_dir, 'models', f'channel_{channel_id}_model.npz')
+
+
+def build_channel_model(result, features, feature_model, labels):
+    """Builds the model that sorts new spikes of a channel like its full sort did.
+
+    Args:
+        result (dict): The spike detection results of the channel.
+        features (ndarray): The features of the clustered spikes, as the pipeline extracted them.
+        feature_model (dict): How they were extracted (see `feature_extraction.fit_feature_model`).
+        labels (ndarray): Their cluster labels.
+
+    Returns:
+        dict: The noise level of the detection, the feature model and the cluster templates.
+    """
+    stdmin = load_spike_detection_config()['std_min']
+    # Thresholds are std_min * noise / 0.6745 in every detection segment
+    noise_level = np.median(np.asarray(result['thresholds'])) * 0.6745 / stdmin
+    return clustered_model(noise_level, features, feature_model, labels)
+
+
+def clustered_model(noise_level, features, feature_model, labels):
+    cluster_labels, centers, spreads = cluster_templates(features, labels)
+    model = {'noise_level': noise_level, 'cluster_labels': cluster_labels, 'centers': centers, 'spreads': spreads}
+    model.update({f'feature_{name}': value for name, value in feature_model.items()})
+    return model
+
+
+def save_channel_model(save_dir, channel_id, model):
+    path = model_path(save_dir, channel_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, **model)
+
+
+def load_channel_model(save_dir, channel_id):
+    """Returns the saved model of a channel, or None if it has none."""
+    path = model_path(save_dir, channel_id)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        model = {name: data[name] for name in data.files}
+    model['noise_level'] = float(model['noise_level'])
+    model['feature_method'] = str(model['feature_method'])
+    return model
+
+
+def bundles_path(save_dir):
+    return os.path.join(save_dir, 'models', 'bundles.json')
+
+
+def save_bundles(save_dir, bundle_dict, artifact_removal):
+    """Saves the bundles of the full sort and whether their artifacts were removed, for `sort_new_chunk`."""
+    def channel_info(info):
+        return {name: value.item() if isinstance(value, np.generic) else value for name, value in info.items()}
+
+    path = bundles_path(save_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    bundles = {bundle_name: [channel_info(info) for info in channel_info_list] for bundle_name, channel_info_list in bundle_dict.items()}
+    with open(path, 'w') as bundles_file:
+        json.dump({'artifact_removal': bool(artifact_removal), 'bundle_dict': bundles}, bundles_file, indent=2)
+
+
+def load_bundles(save_dir):
+    """Returns the bundle dictionary saved by `save_bundles`, or None if the artifacts were not removed."""
+    path = bundles_path(save_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as bundles_file:
+        bundles = json.load(bundles_file)
+    return bundles['bundle_dict'] if bundles['artifact_removal'] else None
+
+
+def save_sorting_models(save_dir, spike_detection_results, features, feature_models, labels):
+    """Saves the model of every clustered channel in `<save_dir>/models`, for `sort_new_chunk`.
+
+    Args:
+        save_dir (str): Output folder of the full sort.
+        spike_detection_results (dict): The spike detection results of each channel.
+        features (dict): The features that were clustered (after artifacts removal, if any).
+        feature_models (dict): The feature model of each channel (see `feature_extraction.feature_extraction`).
+        labels (dict): The cluster labels of each channel.
+    """
+    for channel_id, channel_labels in labels.items():
+        model = build_channel_model(spike_detection_results[channel_id], features[channel_id], feature_models[channel_id], channel_labels)
+        save_channel_model(save_dir, channel_id, model)
+
+
+def sort_new_chunk(recording, recording_bp2, recording_bp4, save_dir, profiler=None):
+    """Sorts a new chunk of a recording against the models of an earlier full sort.
+
+    Spikes are detected with the noise levels of the full sort, their waveforms are
+    extracted and projected on its features, and each spike is assigned to the nearest
+    cluster template within `template_sdnum` spreads of the clustering config (label 0 otherwise).
+
+    When the fraction of unassigned spikes of a channel is over `recluster_fraction`, the
+    unassigned spikes are clustered with SPC, in the same feature space, and the clusters
+    found are added to the model as new templates. Labels continue across chunks: the
+    templates of the full sort and of earlier chunks are kept with their labels, and the new
+    clusters get fresh labels after the largest label of the model. So a label means the
+    same cluster in the full sort and in every chunk, and the spikes sorted before are never
+    relabeled. The model is saved with the added templates, for the next chunks.
+
+    If the full sort removed artifacts, the models were built from the spikes it kept, so the
+    artifacts of the chunk are removed first, with the bundles saved by `save_bundles`, and
+    only the kept spikes are sorted and returned. Channels without a saved model are skipped.
+
+    Args:
+        recording: The new chunk.
+        recording_bp2: The chunk after the bp2 (sorting) bandpass filter.
+        recording_bp4: The chunk after the bp4 (detection) bandpass filter.
+        save_dir (str): Output folder of the full sort, holding the models.
+        profiler (PipelineProfiler): Profiler that logs the reclustered channels. By default, a
+                                     verbose one.
+
+    Returns:
+        dict: For each channel, a dictionary with the 'spikes' (ms) and 'indexes' of the chunk,
+              their 'labels', the 'unassigned_fraction' of the template assignment, whether
+              the channel was 'reclustered' and the labels of its 'new_clusters'.
+    """
+    if profiler is None:
+        profiler = PipelineProfiler()
+    clustering_config = load_clustering_config()
+    template_sdnum = clustering_config.get('template_sdnum', 3)
+    recluster_fraction = load_incremental_config().get('recluster_fraction', 0.2)
+
+    models = {channel_id: load_channel_model(save_dir, channel_id) for channel_id in recording.get_channel_ids()}
+    models = {channel_id: model for channel_id, model in models.items() if model is not None}
+    if not models:
+        return {}
+    channel_ids = list(models.keys())
+    recording = recording.select_channels(channel_ids)
+    recording_bp2 = recording_bp2.select_channels(channel_ids)
+    recording_bp4 = recording_bp4.select_channels(channel_ids)
+
+    noise_levels = {channel_id: model['noise_level'] for channel_id, model in models.items()}
+    spike_detection_results = detect_spikes(recording, recording_bp2, recording_bp4, noise_levels=noise_levels)
+    bundle_dict = load_bundles(save_dir)
+    if bundle_dict is not None:
+        # Artifacts would fit no template, and be clustered as new ones
+        spike_detection_results, _ = artifacts_removal_for_bundle(spike_detection_results, bundle_dict, sr=recording.get_sampling_frequency())
+        models = {channel_id: model for channel_id, model in models.items() if channel_id in spike_detection_results}
+    waveforms = extract_waveforms(spike_detection_results, recording_bp2)
+
+    chunk_results = {}
+    for channel_id, model in models.items():
+        result = spike_detection_results[channel_id]
+        feature_model = {name[len('feature_'):]: value for name, value in model.items() if name.startswith('feature_')}
+        labels = np.zeros(len(waveforms[channel_id]), dtype=int)
+        if len(labels):
+            features = project_features(waveforms[channel_id], feature_model)
+            labels = assign_to_templates(features, model['cluster_labels'], model['centers'], model['spreads'], template_sdnum)
+        unassigned_fraction = float(np.mean(labels == 0)) if len(labels) else 0.0
+
+        unassigned = labels == 0
+        # SPC needs at least min_clus spikes to find a cluster
+        reclustered = unassigned_fraction > recluster_fraction and np.count_nonzero(unassigned) >= clustering_config['min_clus']
+        new_clusters = np.zeros(0, dtype=int)
+        if reclustered:
+            profiler.log(f'channel {channel_id}: {unassigned_fraction:.0%} of the spikes unassigned, clustering them')
+            new_labels, _ = SPC_clustering({channel_id: features[unassigned]}, profiler=profiler)
+            new_labels = np.asarray(new_labels[channel_id])
+            # New clusters are numbered after the labels of the model, which keep their meaning
+            next_label = int(model['cluster_labels'].max()) + 1 if len(model['cluster_labels']) else 1
+            new_labels = np.where(new_labels > 0, new_labels - 1 + next_label, 0)
+            labels[unassigned] = new_labels
+            new_clusters, centers, spreads = cluster_templates(features[unassigned], new_labels)
+            model['cluster_labels'] = np.concatenate([model['cluster_labels'], new_clusters])
+            model['centers'] = np.concatenate([model['centers'].reshape(-1, features.shape[1]), centers])
+            model['spreads'] = np.concatenate([model['spreads'], spreads])
+            save_channel_model(save_dir, channel_id, model)
+
+        chunk_results[channel_id] = {
+            'spikes': result['spikes'],
+            'indexes': result['indexes'],
+            'labels': labels,
+            'unassigned_fraction': unassigned_fraction,
+            'reclustered': reclustered,
+            'new_clusters': new_clusters,
+        }
+    return chunk_results
@@ -0,0 +1,224 @@
+# instrumentation.py
+import cProfile
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from multiprocessing.context import get_spawning_popen
+import numpy as np
+import yaml
+from spikeinterface.core import BaseRecording, BaseRecordingSegment
+
+
+def load_instrumentation_config():
+    file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+    with open(file_path, 'r') as config_file:
+        config = yaml.safe_load(config_file)
+        return config['pipeline']
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+class ReadCounter:
+    """Process-safe counter of the bytes read from a recording.
+
+    The count is held in shared memory, so the copies of the counter that reach worker
+    processes with a `CountingRecording` (e.g. in the initargs of a process pool) add to the
+    same count. Synchronized values can only be passed to a process as it starts: a copy
+    pickled any other way counts on its own.
+    """
+
+    def __init__(self):
+        self._value = multiprocessing.Value('q', 0)
+
+    @property
+    def bytes_read(self):
+        return self._value.value
+
+    def add(self, nbytes):
+        with self._value.get_lock():
+            self._value.value += nbytes
+
+    def __getstate__(self):
+        return {'value': self._value if get_spawning_popen() is not None else None}
+
+    def __setstate__(self, state):
+        self._value = state['value'] if state['value'] is not None else multiprocessing.Value('q', 0)
+
+
+class CountingRecordingSegment(BaseRecordingSegment):
+    def __init__(self, parent_segment, counter):
+        BaseRecordingSegment.__init__(self, **parent_segment.get_times_kwargs())
+        self._parent_segment = parent_segment
+        self._counter = counter
+
+    def get_num_samples(self):
+        return self._parent_segment.get_num_samples()
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        traces = self._parent_segment.get_traces(start_frame, end_frame, channel_indices)
+        self._counter.add(traces.nbytes)
+        return traces
+
+
+class CountingRecording(BaseRecording):
+    """Recording that forwards to `parent_recording` and counts the bytes of the traces read.
+
+    The counter is part of its arguments, so a copy rebuilt in a worker process counts the
+    bytes it reads in the same `ReadCounter`.
+    """
+
+    def __init__(self, parent_recording, counter):
+        BaseRecording.__init__(self, sampling_frequency=parent_recording.get_sampling_frequency(),
+                               channel_ids=parent_recording.get_channel_ids(), dtype=parent_recording.get_dtype())
+        for parent_segment in parent_recording._recording_segments:
+            self.add_recording_segment(CountingRecordingSegment(parent_segment, counter))
+        parent_recording.copy_metadata(self)
+        self._kwargs = {'parent_recording': parent_recording, 'counter': counter}
+
+
+class PipelineProfiler:
+    """Records wall time, CPU time, memory, bytes read and counts of pipeline stages.
+
+    Stages are timed with the `stage` context manager, either for all channels or for one
+    channel. Every entry holds:
+        - stage, channel: the stage name and the channel id (None for the whole stage)
+        - wall_time, cpu_time: in seconds (CPU time of this process, all threads)
+        - peak_rss_mb: peak resident memory of the process at the end of the stage
+        - peak_traced_mb: peak memory allocated during the stage, if `trace_memory` is set
+          (for a stage with per-channel stages inside, the peak after its last channel)
+        - bytes_read: bytes read from the recordings wrapped with `counting`, including
+          by the worker processes they are passed to
+        - any counts given to `stage` or added with `count` (e.g. spikes, waveforms, features)
+
+    Args:
+        trace_memory (bool): Track the peak allocated memory of each stage with tracemalloc.
+                             Accurate for numpy arrays, but slows down pure Python code.
+        profile_dir (str): If given, each outermost stage is run under cProfile and its statistics
+                           are dumped to `<profile_dir>/<stage>[_channel_<id>].prof`. Stages inside a
+                           profiled stage (e.g. its per-channel stages) are part of its profile, since
+                           only one profiler can be active at a time.
+        verbose (bool): Print the start and end of the stages that cover all channels, and the
+                        messages passed to `log`.
+    """
+
+    def __init__(self, trace_memory=False, profile_dir=None, verbose=True):
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.verbose = verbose
+        self.entries = []
+        self.counter = ReadCounter()
+        self._profiling = False
+        self._start = time.perf_counter()
+
+    def counting(self, recording):
+        """Wraps a recording so the bytes read from it are attributed to the running stage."""
+        return CountingRecording(recording, self.counter)
+
+    @contextmanager
+    def stage(self, name, channel_id=None, **counts):
+        """Times the code in the block as stage `name`, for `channel_id` or all channels.
+
+        Yields:
+            dict: The entry of the stage, to which counts can be added.
+        """
+        entry = {'stage': name, 'channel': None if channel_id is None else _to_json(channel_id)}
+        entry.update(counts)
+        if channel_id is None:
+            self.log(f'start {name}...')
+
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        # Nested stages are already in the profile of the outer stage
+        profiler = cProfile.Profile() if self.profile_dir and not self._profiling else None
+        bytes_read = self.counter.bytes_read
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if profiler is not None:
+            self._profiling = True
+            profiler.enable()
+        try:
+            yield entry
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+            entry['wall_time'] = time.perf_counter() - wall_start
+            entry['cpu_time'] = time.process_time() - cpu_start
+            entry['bytes_read'] = self.counter.bytes_read - bytes_read
+            entry['peak_rss_mb'] = peak_rss_mb()
+            if self.trace_memory:
+                entry['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                suffix = '' if channel_id is None else f'_channel_{channel_id}'
+                profiler.dump_stats(os.path.join(self.profile_dir, f'{name}{suffix}.prof'))
+            self.entries.append(entry)
+            if channel_id is None:
+                self.log(f'end {name}! ({entry["wall_time"]:.1f} s)')
+
+    def log(self, message):
+        """Prints a progress message, if `verbose` is set."""
+        if self.verbose:
+            print(message)
+
+    def count(self, name, channel_id=None, **counts):
+        """Adds counts to the last entry of a stage, or a new entry without timings."""
+        channel = None if channel_id is None else _to_json(channel_id)
+        for entry in reversed(self.entries):
+            if entry['stage'] == name and entry['channel'] == channel:
+                entry.update(counts)
+                return
+        self.entries.append({'stage': name, 'channel': channel, **counts})
+
+    def count_channels(self, name, values, key):
+        """Adds the number of rows of each channel's value in `values` as count `key`."""
+        for channel_id, value in values.items():
+            self.count(name, channel_id, **{key: len(value)})
+
+    def report(self):
+        """Returns the structured report: per-stage totals and every entry."""
+        # Channel timings are part of the timing of their whole stage, when there is one
+        whole_stages = {entry['stage'] for entry in self.entries if entry['channel'] is None and 'wall_time' in entry}
+        stages = {}
+        for entry in self.entries:
+            totals = stages.setdefault(entry['stage'], {})
+            for field, value in entry.items():
+                if field in ('stage', 'channel') or not isinstance(value, (int, float)):
+                    continue
+                if field in ('peak_rss_mb', 'peak_traced_mb'):
+                    totals[field] = max(totals.get(field, 0), value)
+                elif field in ('wall_time', 'cpu_time', 'bytes_read') and entry['channel'] is not None and entry['stage'] in whole_stages:
+                    continue
+                else:
+                    totals[field] = totals.get(field, 0) + value
+        return {
+            'total_wall_time': time.perf_counter() - self._start,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': stages,
+            'entries': self.entries,
+        }
+
+    def save(self, file_name):
+        """Saves the report as JSON."""
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+        with open(file_name, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2, default=_to_json)
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
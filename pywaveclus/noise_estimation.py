@@ -0,0 +1,118 @@
+# noise_estimation.py
+"""Estimators of the noise level of a detection segment, the median of its absolute values.
+
+The detection threshold of a segment is `std_min * noise / 0.6745`. The estimator is
+chosen with `noise_method` in the spike_detection section of config.yaml:
+
+- 'median': the exact median, with a single absolute-value buffer that is partitioned in
+  place (`np.median` makes a second copy to partition). Identical to
+  `np.median(np.abs(trace))`.
+- 'strided': the median of every k-th sample, with k chosen so that about `noise_samples`
+  samples are used. No copy of the segment is made.
+- 'random': the median of `noise_samples` samples drawn at random (with a fixed seed).
+  For both subsampling methods, with independent Gaussian noise, the relative standard error
+  versus the exact value is about 1.17 / sqrt(noise_samples), i.e. 0.12% for 1,000,000
+  samples. Bandpassed samples closer than the filter's correlation length (a few samples at
+  300-3000 Hz) are not independent, so the strided error grows if k gets that small.
+- 'sketch': a streaming quantile sketch with logarithmic buckets (as DDSketch) fed in
+  chunks, so only a chunk-sized buffer is allocated. The estimate is always within a
+  relative error of `noise_accuracy` of the exact median.
+"""
+from functools import partial
+import numpy as np
+
+SKETCH_CHUNK_SIZE = 1 << 20
+
+
+def exact_median_noise(trace):
+    """Returns `np.median(np.abs(trace))`, partitioning one buffer in place."""
+    values = np.abs(np.ravel(trace))
+    n = len(values)
+    if n == 0:
+        return np.nan
+    k = n // 2
+    if n % 2:
+        values.partition(k)
+        return values[k]
+    values.partition([k - 1, k])
+    return np.mean(values[k - 1:k + 1])
+
+
+def strided_noise(trace, num_samples):
+    """Returns the median absolute value of about `num_samples` evenly strided samples."""
+    trace = np.ravel(trace)
+    step = max(1, len(trace) // num_samples)
+    return exact_median_noise(trace[::step])
+
+
+def random_noise(trace, num_samples, seed=0):
+    """Returns the median absolute value of `num_samples` samples drawn at random."""
+    trace = np.ravel(trace)
+    if len(trace) <= num_samples:
+        return exact_median_noise(trace)
+    indexes = np.random.default_rng(seed).integers(0, len(trace), num_samples)
+    return exact_median_noise(trace[indexes])
+
+
+def sketch_noise(trace, relative_accuracy=0.001, chunk_size=SKETCH_CHUNK_SIZE):
+    """Returns the median absolute value from a logarithmic-bucket quantile sketch.
+
+    Each nonzero value x falls in bucket ceil(log_gamma(x)), with gamma = (1 + a) / (1 - a)
+    for a relative accuracy a. Every value of a bucket is within a relative error a of the
+    bucket's representative value 2 * gamma**i / (gamma + 1), so the median estimate is too.
+    """
+    trace = np.ravel(trace)
+    n = len(trace)
+    if n == 0:
+        return np.nan
+    log_gamma = np.log((1 + relative_accuracy) / (1 - relative_accuracy))
+
+    zeros = 0
+    counts = np.zeros(0, dtype=np.int64)
+    offset = 0
+    for start in range(0, n, chunk_size):
+        values = np.abs(trace[start:start + chunk_size])
+        nonzero = values[values > 0]
+        zeros += len(values) - len(nonzero)
+        if len(nonzero) == 0:
+            continue
+        index = np.ceil(np.log(nonzero.astype(np.float64)) / log_gamma).astype(np.int64)
+        chunk_offset = index.min()
+        chunk_counts = np.bincount(index - chunk_offset)
+        # Merge the bucket counts, keeping them contiguous from the lowest bucket
+        if len(counts) == 0:
+            counts, offset = chunk_counts, chunk_offset
+            continue
+        merged_offset = min(offset, chunk_offset)
+        merged = np.zeros(max(offset + len(counts), chunk_offset + len(chunk_counts)) - merged_offset, dtype=np.int64)
+        merged[offset - merged_offset:offset - merged_offset + len(counts)] += counts
+        merged[chunk_offset - merged_offset:chunk_offset - merged_offset + len(chunk_counts)] += chunk_counts
+        counts, offset = merged, merged_offset
+    cumulative = np.cumsum(counts)
+
+    def quantile(rank):
+        if rank < zeros:
+            return 0.0
+        bucket = offset + np.searchsorted(cumulative, rank - zeros, side='right')
+        return 2 * np.exp(bucket * log_gamma) / (np.exp(log_gamma) + 1)
+
+    k = n // 2
+    if n % 2:
+        return quantile(k)
+    return (quantile(k - 1) + quantile(k)) / 2
+
+
+def noise_estimator(config):
+    """Returns the noise estimator (a function of a trace) set in the spike detection config."""
+    method = config.get('noise_method', 'median')
+    num_samples = config.get('noise_samples', 1000000)
+    if method == 'median':
+        return exact_median_noise
+    elif method == 'strided':
+        return partial(strided_noise, num_samples=num_samples)
+    elif method == 'random':
+        return partial(random_noise, num_samples=num_samples)
+    elif method == 'sketch':
+        relative_accuracy = config.get('noise_accuracy', 0.001)
+        return partial(sketch_noise, relative_accuracy=relative_accuracy)
+    raise ValueError(f"Invalid value {method} for argument 'noise_method'. Must be 'median', 'strided', 'random' or 'sketch'.")
@@ -0,0 +1,347 @@
+# scheduler.py
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+import yaml
+from .spike_detection import detect_spikes, bundle_channel_groups
+from .artifacts_removal import artifacts_removal_for_bundle
+from .waveform_extraction import load_waveform_extraction_config, read_spike_snippets, align_spikes, precision_dtype
+from .feature_extraction import feature_extraction, load_feature_extraction_config
+from .clustering import SPC_clustering
+from .columnar_output import save_channel_data_to_npy
+from .instrumentation import PipelineProfiler
+from .waveform_store import WaveformStore
+from .incremental import build_channel_model, save_channel_model, load_incremental_config
+
+
+def load_pipeline_config():
+    file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+    with open(file_path, 'r') as config_file:
+        config = yaml.safe_load(config_file)
+        return config['pipeline']
+
+
+def resolve_n_workers(n_workers):
+    """Returns the number of worker processes, where 0 means one per CPU."""
+    return n_workers if n_workers > 0 else os.cpu_count()
+
+
+class _SamplingInfo:
+    """Stands in for the recording in the savers, which only need its sampling frequency."""
+
+    def __init__(self, sr):
+        self.sr = sr
+
+    def get_sampling_frequency(self):
+        return self.sr
+
+
+def to_shared_memory(array):
+    """Copies an array into a new shared memory block.
+
+    Returns:
+        tuple: The SharedMemory block (to be closed and unlinked by the caller) and the
+               (name, shape, dtype) descriptor that `from_shared_memory` needs.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def from_shared_memory(descriptor):
+    """Returns a copy of the array held in the shared memory block of `descriptor`.
+
+    The block stays owned, and is unlinked, by the process that created it.
+    """
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+
+
+def sort_channel(channel_id, snippets_descriptor, result, filtered_result, sr, save_dir, output_format='mat'):
+    """Runs extraction, feature extraction, clustering and saving for a single channel.
+
+    Args:
+        channel_id: The channel to sort.
+        snippets_descriptor (tuple): Shared memory descriptor of the raw bp2 snippets of the channel.
+        result (dict): The spike detection results of the channel.
+        filtered_result (dict): The results after artifacts removal, or None without artifacts removal.
+        sr (float): Sampling frequency of the recording.
+        save_dir (str): Output folder.
+        output_format (str): 'mat' for a MATLAB file, 'npy' for a folder of .npy columns.
+
+    Returns:
+        tuple: The cluster labels and SPC metadata of the channel, and the profiler entries of its stages.
+    """
+    # Imported here since waveclus imports this module
+    from .waveclus import save_channel_data_to_mat, save_channel_data_to_mat_artifact
+
+    profiler = PipelineProfiler(verbose=False)
+    config = load_waveform_extraction_config()
+    snippets = from_shared_memory(snippets_descriptor)
+    with profiler.stage('extract_waveforms', channel_id):
+        waveforms = {channel_id: align_spikes(snippets, config.get('detect_method', 'neg'), config.get('w_pre', 20),
+                                              config.get('w_post', 44), config.get('int_factor', 5), dtype=precision_dtype(config))}
+    profiler.count_channels('extract_waveforms', waveforms, 'waveforms')
+    waveforms = {channel_id: WaveformStore(waveforms[channel_id], result['indexes'])}
+    results = {channel_id: result}
+    recording_info = _SamplingInfo(sr)
+
+    if filtered_result is not None:
+        filtered_results = {channel_id: filtered_result}
+        filtered_waveforms = {channel_id: waveforms[channel_id].select(filtered_result['keep'])}
+    else:
+        filtered_waveforms = waveforms
+
+    with profiler.stage('feature_extraction', channel_id):
+        feature_models = {}
+        features = feature_extraction(filtered_waveforms, feature_models)
+    profiler.count_channels('feature_extraction', features, 'features')
+    with profiler.stage('SPC_clustering', channel_id):
+        labels, metadata = SPC_clustering(features, profiler=profiler)
+
+    with profiler.stage('save', channel_id):
+        if filtered_result is not None:
+            if output_format == 'npy':
+                save_channel_data_to_npy(recording_info, channel_id, results, waveforms, features, labels, save_dir, filtered_results)
+            else:
+                save_channel_data_to_mat_artifact(recording_info, channel_id, results, filtered_results, waveforms, filtered_waveforms, features, labels, save_dir=save_dir)
+        else:
+            if output_format == 'npy':
+                save_channel_data_to_npy(recording_info, channel_id, results, waveforms, features, labels, save_dir)
+            else:
+                save_channel_data_to_mat(recording_info, channel_id, results, waveforms, features, labels, save_dir=save_dir)
+
+    if load_incremental_config().get('save_models', False):
+        with profiler.stage('save_models', channel_id):
+            save_channel_model(save_dir, channel_id, build_channel_model(result, features[channel_id], feature_models[channel_id], labels[channel_id]))
+
+    return labels[channel_id], metadata[channel_id], profiler.entries
+
+
+def sort_channels_in_pool(recording, recording_bp2, recording_bp4, bundle_dict, artifact_removal=False, save_dir=None, fused=False, n_workers=0, profiler=None, plotter=None):
+    """Runs the spike sorting pipeline with one task per channel in a process pool.
+
+    Spike detection runs first for all channels. Each channel is then extracted,
+    featurized, clustered and saved by a worker process. The raw bp2 snippets are read
+    in this process and handed to the workers through shared memory. At most one channel
+    more than there are workers is in flight, so the next channel is ready when a worker
+    frees up, and the shared memory of a channel is released as soon as it is sorted: the
+    memory is bounded by the number of workers rather than of channels (in fused mode the
+    snippets cut during detection are still held until their channel is submitted). With
+    artifacts removal, the channels of a bundle are submitted as soon as that bundle is filtered.
+
+    Args:
+        recording: Raw recording.
+        recording_bp2: Recording after the bp2 (sorting) bandpass filter.
+        recording_bp4: Recording after the bp4 (detection) bandpass filter.
+        bundle_dict (dict): Dictionary containing parameters for artifacts removal.
+        artifact_removal (bool): Whether to remove artifacts per bundle.
+        save_dir (str): Output folder.
+        fused (bool): If True, the snippets are cut during spike detection.
+        n_workers (int): Number of worker processes, 0 for one per CPU.
+        profiler (PipelineProfiler): Optional profiler collecting the stages of this process and of the workers.
+        plotter (TemperaturePlotter): Optional plotter the SPC metadata of each channel is queued to.
+
+    Returns:
+        dict: The cluster labels of each sorted channel.
+    """
+    config = load_waveform_extraction_config()
+    w_pre = config.get('w_pre', 20)
+    w_post = config.get('w_post', 44)
+    chunk_duration = config.get('chunk_duration', 0) or None
+    # Snippets are shared in float32 in float32 precision, as read otherwise
+    snippet_dtype = None if precision_dtype(config) == np.float64 else precision_dtype(config)
+    sr = recording.get_sampling_frequency()
+    output_format = load_pipeline_config().get('output_format', 'mat')
+    if profiler is None:
+        profiler = PipelineProfiler(verbose=False)
+    recording_bp2 = profiler.counting(recording_bp2)
+    recording_bp4 = profiler.counting(recording_bp4)
+
+    channel_groups = bundle_channel_groups(bundle_dict)
+    with profiler.stage('detect_spikes'):
+        if fused:
+            spike_detection_results, snippets = detect_spikes(recording, recording_bp2, recording_bp4, snippet_window=(w_pre, w_post), channel_groups=channel_groups)
+        else:
+            spike_detection_results = detect_spikes(recording, recording_bp2, recording_bp4, channel_groups=channel_groups)
+            snippets = {}
+    profiler.count_channels('detect_spikes', {channel_id: result['indexes'] for channel_id, result in spike_detection_results.items()}, 'spikes')
+
+    if artifact_removal:
+        # Channels only wait for the artifacts removal of their own bundle
+        channel_batches = ((bundle_name, {bundle_name: channel_info_list}) for bundle_name, channel_info_list in bundle_dict.items())
+    else:
+        channel_batches = [(None, None)]
+
+    workers = resolve_n_workers(n_workers)
+    running = {}
+    labels = {}
+    submitted = []
+
+    def release(done):
+        for future in done:
+            channel_id, block = running.pop(future)
+            try:
+                labels[channel_id], metadata, entries = future.result()
+            finally:
+                block.close()
+                block.unlink()
+            profiler.entries.extend(entries)
+            if plotter is not None:
+                plotter.submit(channel_id, metadata)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            for bundle_name, bundle in channel_batches:
+                if bundle is None:
+                    filtered_results = {channel_id: None for channel_id in spike_detection_results}
+                else:
+                    with profiler.stage('artifacts_removal_for_bundle', bundle_name):
+                        filtered_results, _ = artifacts_removal_for_bundle(spike_detection_results, bundle, sr=sr)
+
+                for channel_id, filtered_result in filtered_results.items():
+                    # Wait for a worker to free up before copying more snippets to shared memory
+                    while len(running) > workers:
+                        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                        release(done)
+                    result = spike_detection_results[channel_id]
+                    if channel_id in snippets:
+                        channel_snippets = snippets.pop(channel_id)
+                    else:
+                        with profiler.stage('read_spike_snippets', channel_id):
+                            channel_snippets = read_spike_snippets(recording_bp2, channel_id, result['indexes'], w_pre, w_post, chunk_duration, snippet_dtype)
+                    block, descriptor = to_shared_memory(channel_snippets)
+                    del channel_snippets
+                    future = executor.submit(sort_channel, channel_id, descriptor, result, filtered_result, sr, save_dir, output_format)
+                    running[future] = (channel_id, block)
+                    submitted.append(channel_id)
+            release(list(running))
+        finally:
+            for _, block in running.values():
+                block.close()
+                block.unlink()
+
+    # In the order the channels were submitted, not finished
+    labels = {channel_id: labels[channel_id] for channel_id in submitted}
+    return labels
+
+
+def estimate_channel_memory(nspk, config, feature_config, batch_size=65536):
+    """Estimates the peak memory, in bytes, of sorting one channel of `nspk` spikes.
+
+    The terms are the raw snippets (held in shared memory and copied by the worker), the
+    upsampled buffer of `align_spikes` (bounded by its batch size), the waveforms, the
+    wavelet coefficients or PCA scores and features, and the SPC cluster labels at each
+    temperature and neighbour graph.
+    """
+    itemsize = np.dtype(precision_dtype(config)).itemsize
+    ls = config.get('w_pre', 20) + config.get('w_post', 44)
+    snippet_length = ls + 4
+    upsampled = min(nspk, batch_size) * snippet_length * config.get('int_factor', 5) * itemsize
+    per_spike = 2 * snippet_length * 8 + 2 * ls * itemsize + feature_config.get('haar_max_inputs', 48) * 8
+    # SPC keeps the cluster of every spike at each of its 26 temperatures, and 11 neighbours per spike
+    per_spike += 26 * 8 + 2 * 11 * 8
+    return upsampled + nspk * per_spike
+
+
+def sort_channels_streaming(recording, recording_bp2, recording_bp4, bundle_dict, artifact_removal=False, save_dir=None, n_workers=0, memory_budget_gb=4, profiler=None, plotter=None):
+    """Runs the spike sorting pipeline channel by channel within a memory budget.
+
+    Spike detection runs first for all channels; its `SpikeTable` (the spike times) is the
+    only data kept across channels, for artifacts removal. Channels are then submitted one at a
+    time to worker processes, which extract, featurize, cluster and save them (see
+    `sort_channel`). A channel is only submitted when the estimated memory of the channels
+    running (see `estimate_channel_memory`) leaves room for it in `memory_budget_gb`, so
+    the budget, rather than the number of channels, bounds the memory; a channel over the
+    whole budget runs alone. The snippets, waveforms, features and labels of a channel are
+    released as soon as it is saved. The raw snippets are read without fusing them into
+    detection, since that would hold those of every channel at once; set `chunk_duration`
+    in the extract_waveform section to also bound the trace read for them.
+
+    Args:
+        recording: Raw recording.
+        recording_bp2: Recording after the bp2 (sorting) bandpass filter.
+        recording_bp4: Recording after the bp4 (detection) bandpass filter.
+        bundle_dict (dict): Dictionary containing parameters for artifacts removal.
+        artifact_removal (bool): Whether to remove artifacts per bundle.
+        save_dir (str): Output folder.
+        n_workers (int): Maximum number of worker processes, 0 for one per CPU.
+        memory_budget_gb (float): Memory budget of the channels running at once, in GB.
+        profiler (PipelineProfiler): Optional profiler collecting the stages of this process and of the workers.
+        plotter (TemperaturePlotter): Optional plotter the SPC metadata of each channel is queued to.
+
+    Returns:
+        dict: The number of spikes sorted in each channel.
+    """
+    config = load_waveform_extraction_config()
+    feature_config = load_feature_extraction_config()
+    w_pre = config.get('w_pre', 20)
+    w_post = config.get('w_post', 44)
+    chunk_duration = config.get('chunk_duration', 0) or None
+    snippet_dtype = None if precision_dtype(config) == np.float64 else precision_dtype(config)
+    sr = recording.get_sampling_frequency()
+    output_format = load_pipeline_config().get('output_format', 'mat')
+    memory_budget = memory_budget_gb * 1024 ** 3
+    if profiler is None:
+        profiler = PipelineProfiler(verbose=False)
+    recording_bp2 = profiler.counting(recording_bp2)
+    recording_bp4 = profiler.counting(recording_bp4)
+
+    with profiler.stage('detect_spikes'):
+        spike_detection_results = detect_spikes(recording, recording_bp2, recording_bp4, channel_groups=bundle_channel_groups(bundle_dict))
+    profiler.count_channels('detect_spikes', {channel_id: result['indexes'] for channel_id, result in spike_detection_results.items()}, 'spikes')
+
+    def channel_tasks():
+        # Bundles are filtered one at a time, as their channels are submitted
+        if not artifact_removal:
+            for channel_id, result in spike_detection_results.items():
+                yield channel_id, result, None
+            return
+        for bundle_name, channel_info_list in bundle_dict.items():
+            with profiler.stage('artifacts_removal_for_bundle', bundle_name):
+                filtered_results, _ = artifacts_removal_for_bundle(spike_detection_results, {bundle_name: channel_info_list}, sr=sr)
+            for channel_id, filtered_result in filtered_results.items():
+                yield channel_id, spike_detection_results[channel_id], filtered_result
+
+    running = {}
+    sorted_spikes = {}
+
+    def release(done):
+        for future in done:
+            channel_id, block, _ = running.pop(future)
+            try:
+                labels, metadata, entries = future.result()
+            finally:
+                block.close()
+                block.unlink()
+            profiler.entries.extend(entries)
+            sorted_spikes[channel_id] = len(labels)
+            if plotter is not None:
+                plotter.submit(channel_id, metadata)
+
+    with ProcessPoolExecutor(max_workers=resolve_n_workers(n_workers)) as executor:
+        try:
+            for channel_id, result, filtered_result in channel_tasks():
+                estimate = estimate_channel_memory(len(result['indexes']), config, feature_config)
+                # Wait for running channels to finish until this one fits in the budget
+                while running and sum(memory for _, _, memory in running.values()) + estimate > memory_budget:
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    release(done)
+                with profiler.stage('read_spike_snippets', channel_id):
+                    channel_snippets = read_spike_snippets(recording_bp2, channel_id, result['indexes'], w_pre, w_post, chunk_duration, snippet_dtype)
+                block, descriptor = to_shared_memory(channel_snippets)
+                del channel_snippets
+                future = executor.submit(sort_channel, channel_id, descriptor, result, filtered_result, sr, save_dir, output_format)
+                running[future] = (channel_id, block, estimate)
+            release(list(running))
+        finally:
+            for _, block, _ in running.values():
+                block.close()
+                block.unlink()
+
+    return sorted_spikes
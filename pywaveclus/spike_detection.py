@@ -1,9 +1,11 @@
 # spike_detection.py
 import math
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor
-from spikeinterface import ChannelSliceRecording
+from numpy.lib.stride_tricks import sliding_window_view
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from scipy.interpolate import splev, splrep
+from .noise_estimation import noise_estimator
+from .spike_table import SpikeTable
 import yaml
 import os
 
@@ -14,7 +16,123 @@ def load_spike_detection_config():
         return config['spike_detection']
 
 
-def detect_spikes(recording, recording_bp2, recording_bp4):
+def find_threshold_crossings(trace_bp4, thr, detect, w_pre, w_post, sample_ref):
+    """Finds the samples of a segment that cross the detection threshold.
+
+    Args:
+        trace_bp4: Detection-band trace of a single channel segment.
+        thr: Detection threshold.
+        detect: The detection method ('neg', 'pos', 'both').
+        w_pre: Pre-event window size.
+        w_post: Post-event window size.
+        sample_ref: Half of the refractory period in samples.
+
+    Returns:
+        ndarray: Sample indexes (relative to the segment) of every crossing sample.
+    """
+    trace_bp4 = np.ravel(trace_bp4)
+    if detect == 'neg':
+        xaux = np.where((trace_bp4[w_pre + 2: -w_post - 2 - int(sample_ref)] < -thr))[0] + w_pre + 1
+    elif detect == 'pos':
+        xaux = np.where((trace_bp4[w_pre + 2: -w_post - 2 - int(sample_ref)] > thr))[0] + w_pre + 1
+    elif detect == 'both':
+        xaux = np.where((np.abs(trace_bp4[w_pre + 2: -w_post - 2 - int(sample_ref)]) > thr))[0] + w_pre + 1
+    else:
+        raise ValueError(f"Invalid value {detect} for argument 'detect'. Must be 'neg', 'pos', or 'both'.")
+    return xaux
+
+
+def filter_threshold_crossings(trace_bp4, xaux, thr, detect):
+    """Keeps the crossings, found at a lower threshold, that also cross `thr`.
+
+    Args:
+        trace_bp4: Detection-band trace of a single channel segment.
+        xaux: Crossing samples found by :func:`find_threshold_crossings` at a lower threshold.
+        thr: The higher detection threshold.
+        detect: The detection method ('neg', 'pos', 'both').
+
+    Returns:
+        ndarray: The crossing samples of `thr`, as :func:`find_threshold_crossings` would find them.
+    """
+    values = np.ravel(trace_bp4)[xaux + 1]
+    if detect == 'neg':
+        return xaux[values < -thr]
+    elif detect == 'pos':
+        return xaux[values > thr]
+    elif detect == 'both':
+        return xaux[np.abs(values) > thr]
+    raise ValueError(f"Invalid value {detect} for argument 'detect'. Must be 'neg', 'pos', or 'both'.")
+
+
+def select_spikes_loop(trace_bp2, xaux, thrmax, ref, sample_ref, w_pre, w_post):
+    """Reference implementation of the spike selection, walking every crossing sample.
+
+    Kept to validate :func:`select_spikes_vectorized` against; see its docstring for the arguments.
+    """
+    xaux0 = 0
+    index = []
+    for i in range(len(xaux)):
+        if xaux[i] >= xaux0 + ref:
+            iaux = np.argmin(trace_bp2[xaux[i]: xaux[i] + int(sample_ref)-1])
+            # Check and eliminate artifacts
+            if np.max(np.abs(trace_bp2[xaux[i] - w_pre: xaux[i] + w_post])) < thrmax:
+                index.append(iaux + xaux[i])
+                xaux0 = index[-1]
+    return np.array(index, dtype=int)
+
+
+def select_spikes_vectorized(trace_bp2, xaux, thrmax, ref, sample_ref, w_pre, w_post, batch_size=65536):
+    """Selects spikes among threshold crossings, aligning them to the bp2 minimum.
+
+    Gives the same result as :func:`select_spikes_loop`. The artifact check and the
+    peak alignment are evaluated for all crossings at once (in batches of ``batch_size``
+    to bound memory), so only the refractory period has to be walked sequentially, and
+    that walk visits accepted spikes only.
+
+    Args:
+        trace_bp2: Sorting-band trace of a single channel segment.
+        xaux: Threshold crossing samples, as returned by :func:`find_threshold_crossings`.
+        thrmax: Artifact threshold; crossings whose window exceeds it are rejected.
+        ref: Refractory period in samples.
+        sample_ref: Half of the refractory period in samples.
+        w_pre: Pre-event window size.
+        w_post: Post-event window size.
+        batch_size: Number of crossings evaluated per batch.
+
+    Returns:
+        ndarray: Sample indexes (relative to the segment) of the detected spikes.
+    """
+    trace_bp2 = np.ravel(trace_bp2)
+    peak_len = int(sample_ref) - 1
+    if len(xaux) == 0:
+        return np.array([], dtype=int)
+
+    artifact_windows = sliding_window_view(trace_bp2, w_pre + w_post)
+    peak_windows = sliding_window_view(trace_bp2, peak_len)
+
+    # Crossings rejected as artifacts never update the refractory state, so drop them up front
+    keep = np.empty(len(xaux), dtype=bool)
+    for start in range(0, len(xaux), batch_size):
+        batch = xaux[start:start + batch_size]
+        keep[start:start + batch_size] = np.abs(artifact_windows[batch - w_pre]).max(axis=1) < thrmax
+    candidates = xaux[keep]
+
+    peaks = np.empty(len(candidates), dtype=int)
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start:start + batch_size]
+        peaks[start:start + batch_size] = batch + peak_windows[batch].argmin(axis=1)
+
+    # For each candidate, the first candidate allowed after it by the refractory period
+    next_candidate = np.searchsorted(candidates, peaks + ref, side='left').tolist()
+    index = []
+    i = int(np.searchsorted(candidates, ref, side='left'))
+    while i < len(candidates):
+        index.append(i)
+        i = next_candidate[i]
+    return peaks[index]
+
+
+def detect_spikes(recording, recording_bp2, recording_bp4, snippet_window=None, noise_levels=None, channel_groups=None):
     """Detects spikes from a given recording and all channels.
 
     Args:
@@ -26,79 +144,287 @@ def detect_spikes(recording, recording_bp2, recording_bp4):
         w_pre: Pre-event window size.
         w_post: Post-event window size.
         min_ref_per: Minimum refractory period in milliseconds. Default is 1.5.
+        snippet_window: Optional (w_pre, w_post) tuple. If given, the raw bp2 snippets of
+                        w_pre + w_post + 4 samples around each spike are cut from the segments
+                        already read for detection, so waveforms can be extracted without
+                        reading bp2 again.
+        noise_levels: Optional dictionary with a fixed noise level (the MAD of bp4, before the
+                      0.6745 scaling) for each channel, used instead of estimating it in every
+                      segment, e.g. to detect new data with the thresholds of an earlier sort.
+        channel_groups: Optional list of lists of channel ids (e.g. from `bundle_channel_groups`).
+                        With `read_mode: 'block'`, each segment is read once for all the
+                        channels of a group instead of once per channel. Without groups, a
+                        segment is read once for all channels.
 
     Returns:
-        results: A dictionary where the keys are the channel ids, and the values are
-                  another dictionary with the keys 'spikes', 'thresholds' and 'indexes'.
+        results: A `SpikeTable`, which maps the channel ids to another dictionary with the keys
+                  'spikes', 'thresholds', 'indexes' and 'segments'. 'spikes' are in milliseconds,
+                  'indexes' are sample indexes in the recording and 'segments' the detection
+                  segment of each spike.
+        snippets: Only if `snippet_window` is given, a dictionary with the raw snippets of each
+                  channel, as returned by `waveform_extraction.read_spike_snippets`.
     """
     config = load_spike_detection_config()
-    detect = config['detect_method']
-    segment_duration = config['segment_duration'] * 60
     stdmin = config['std_min']
-    stdmax = config['std_max']
-    w_pre = config['w_pre']
-    w_post = config['w_post']
-    min_ref_per = config['min_ref_per']
-    
-    total_duration = recording_bp4.get_num_frames() / recording_bp4.get_sampling_frequency()
-    num_segments = math.ceil(total_duration / segment_duration)
-
-    sr = recording_bp4.get_sampling_frequency()
-    ref = int(min_ref_per * sr / 1000)
-    sample_ref = np.floor(ref/2)
+    return detect_spikes_for_thresholds(recording, recording_bp2, recording_bp4, [stdmin], config, snippet_window, noise_levels, channel_groups)[stdmin]
+
+
+def detect_spikes_sweep(recording, recording_bp2, recording_bp4, std_mins, snippet_window=None):
+    """Detects spikes for several detection thresholds in a single pass.
+
+    The traces are read and the noise level of each segment is estimated once. The
+    threshold crossings are found at the lowest threshold, and the crossings of every
+    higher threshold are derived from them by filtering.
+
+    Args:
+        recording: The recording object to process.
+        recording_bp2: The recording object for the channels' bandpass 2 data.
+        recording_bp4: The recording object for the channels' bandpass 4 data.
+        std_mins: The threshold factors (std_min) to detect with.
+        snippet_window: Optional (w_pre, w_post) tuple, as in `detect_spikes`.
+
+    Returns:
+        dict: A dictionary where keys are the std_min values and values are what
+              `detect_spikes` returns with that std_min.
+    """
+    config = load_spike_detection_config()
+    return detect_spikes_for_thresholds(recording, recording_bp2, recording_bp4, std_mins, config, snippet_window)
+
+
+def detect_spikes_for_thresholds(recording, recording_bp2, recording_bp4, std_mins, config, snippet_window=None, noise_levels=None, channel_groups=None):
+    """Runs the detection of `detect_spikes_sweep` with the given spike detection config.
+
+    Each channel is split in detection segments of `segment_duration` minutes. With
+    `segment_workers` set to 1, channels are detected in parallel threads and the segments
+    of a channel one after the other. Otherwise every (channel, segment) task, or (group,
+    segment) task in the 'block' read mode, runs in a pool of `segment_workers` processes,
+    and the segments of each channel are merged back in time order.
+    """
+    read_mode = config.get('read_mode', 'channel')
+    if read_mode not in ('channel', 'block'):
+        raise ValueError(f"Invalid value {read_mode} for argument 'read_mode'. Must be 'channel' or 'block'.")
+    segment_workers = config.get('segment_workers', 1)
+    detector = SegmentDetector(config, std_mins, recording_bp4.get_sampling_frequency(), recording_bp2.get_num_frames(), snippet_window, noise_levels)
     channel_ids = recording.get_channel_ids()
-    results = {}
+
+    if segment_workers != 1:
+        groups = block_channel_groups(channel_ids, channel_groups) if read_mode == 'block' else [[channel_id] for channel_id in channel_ids]
+        segment_pieces = {channel_id: [None] * detector.num_segments for channel_id in channel_ids}
+        with ProcessPoolExecutor(max_workers=segment_workers if segment_workers > 0 else os.cpu_count(),
+                                 initializer=init_segment_worker, initargs=(detector, recording_bp2, recording_bp4)) as executor:
+            futures = {(segment_index, tuple(group)): executor.submit(detect_segment_task, group, segment_index)
+                       for group in groups for segment_index in range(detector.num_segments)}
+            for (segment_index, _), future in futures.items():
+                for channel_id, pieces in future.result().items():
+                    segment_pieces[channel_id][segment_index] = pieces
+        channel_results = {channel_id: detector.merge_segments(segment_pieces[channel_id]) for channel_id in channel_ids}
+        return detector.sweep(channel_results)
 
     def process_channel(channel_id):
-        sub_recording_bp4 = ChannelSliceRecording(recording_bp4, [channel_id])
-        sub_recording_bp2 = ChannelSliceRecording(recording_bp2, [channel_id])
-
-        all_spikes = []
-        thresholds = []
-        indexes = []
-
-        for segment_index in range(num_segments):
-            start_time = segment_index * segment_duration
-            end_time = min((segment_index + 1) * segment_duration, total_duration)
-
-            trace_bp4 = sub_recording_bp4.get_traces(start_frame=int(start_time * sr), end_frame=int(end_time * sr))
-            trace_bp2 = sub_recording_bp2.get_traces(start_frame=int(start_time * sr), end_frame=int(end_time * sr))
-
-            thr = stdmin * np.median(np.abs(trace_bp4)) / 0.6745
-            thrmax = stdmax * thr 
-            if detect == 'neg':
-                xaux = np.where((trace_bp4[w_pre + 2: -w_post - 2 - int(sample_ref)] < -thr))[0] + w_pre + 1
-            elif detect == 'pos':
-                xaux = np.where((trace_bp4[w_pre + 2: -w_post - 2 - int(sample_ref)] > thr))[0] + w_pre + 1
-            elif detect == 'both':
-                xaux = np.where((np.abs(trace_bp4[w_pre + 2: -w_post - 2 - int(sample_ref)]) > thr))[0] + w_pre + 1
+        segment_pieces = []
+        for segment_index in range(detector.num_segments):
+            segment_pieces.append(detector.detect_segment(recording_bp2, recording_bp4, [channel_id], segment_index)[channel_id])
+        return detector.merge_segments(segment_pieces)
+
+    def process_block(channel_group, executor):
+        # Each segment is read once for the whole group, and its channels are detected in parallel
+        segment_pieces = {channel_id: [] for channel_id in channel_group}
+        for segment_index in range(detector.num_segments):
+            for channel_id, pieces in detector.detect_segment(recording_bp2, recording_bp4, channel_group, segment_index, executor).items():
+                segment_pieces[channel_id].append(pieces)
+        return {channel_id: detector.merge_segments(pieces) for channel_id, pieces in segment_pieces.items()}
+
+    # Use ThreadPoolExecutor for parallel processing
+    with ThreadPoolExecutor() as executor:
+        if read_mode == 'block':
+            channel_results = {}
+            for channel_group in block_channel_groups(channel_ids, channel_groups):
+                channel_results.update(process_block(channel_group, executor))
+            channel_results = {channel_id: channel_results[channel_id] for channel_id in channel_ids}
+        else:
+            # Submit tasks for each channel to the ThreadPoolExecutor
+            futures = [executor.submit(process_channel, channel_id) for channel_id in channel_ids]
+
+            # Collect the results for each channel as they become available
+            channel_results = {channel_id: future.result() for channel_id, future in zip(channel_ids, futures)}
+
+    return detector.sweep(channel_results)
+
+
+class SegmentDetector:
+    """Detects the spikes of a (channel, segment) pair, with the settings of a detection run.
+
+    Segments are `segment_duration` minutes long. With a `segment_margin` (in ms), each
+    segment is read with that much of its neighbours on both sides, the spikes are detected
+    over the whole read, and only those whose sample falls in the segment itself are kept.
+    A spike within w_pre/w_post samples of a segment boundary, which a segment alone cannot
+    detect, is then detected by the segment it falls in, and by no other one. The noise level,
+    and so the threshold, is still estimated on the segment alone. A margin of 0 is the
+    original behaviour. The detector can be pickled, to detect segments in other processes.
+    """
+
+    def __init__(self, config, std_mins, sr, num_frames, snippet_window=None, noise_levels=None):
+        self.detect = config['detect_method']
+        engine = config.get('detect_engine', 'vectorized')
+        if engine == 'vectorized':
+            self.select_spikes = select_spikes_vectorized
+        elif engine == 'loop':
+            self.select_spikes = select_spikes_loop
+        else:
+            raise ValueError(f"Invalid value {engine} for argument 'detect_engine'. Must be 'vectorized' or 'loop'.")
+        self.segment_duration = config['segment_duration'] * 60
+        self.std_mins = sorted(set(std_mins))
+        self.stdmax = config['std_max']
+        self.w_pre = config['w_pre']
+        self.w_post = config['w_post']
+        self.estimate_noise = noise_estimator(config)
+        self.sr = sr
+        self.num_frames = num_frames
+        self.total_duration = num_frames / sr
+        self.num_segments = math.ceil(self.total_duration / self.segment_duration)
+        self.ref = int(config['min_ref_per'] * sr / 1000)
+        self.sample_ref = np.floor(self.ref/2)
+        self.margin = int(config.get('segment_margin', 0) * sr / 1000)
+        self.snippet_window = snippet_window
+        self.noise_levels = noise_levels
+        if snippet_window is not None:
+            snippet_pre, snippet_post = snippet_window
+            self.snippet_pads = (snippet_pre + 2, snippet_post + 2)
+            self.snippet_offsets = np.arange(-snippet_pre - 2, snippet_post + 2)
+
+    def segment_frames(self, segment_index):
+        start_time = segment_index * self.segment_duration
+        end_time = min((segment_index + 1) * self.segment_duration, self.total_duration)
+        return start_time, int(start_time * self.sr), int(end_time * self.sr)
+
+    def read_segment(self, recording_bp2, recording_bp4, segment_channel_ids, start_frame, end_frame):
+        """Reads a segment with its margins; returns the bp4 and bp2 traces and the margin lengths."""
+        margin_pre = min(self.margin, start_frame)
+        margin_post = min(self.margin, self.num_frames - end_frame)
+        read_start, read_end = start_frame - margin_pre, end_frame + margin_post
+        trace_bp4 = recording_bp4.get_traces(channel_ids=segment_channel_ids, start_frame=read_start, end_frame=read_end)
+        if self.snippet_window is None:
+            trace_bp2 = recording_bp2.get_traces(channel_ids=segment_channel_ids, start_frame=read_start, end_frame=read_end)
+            return trace_bp4, trace_bp2, 0, margin_pre
+        # Read the snippet margins as well, so spikes at the segment edges get full snippets
+        pad_pre = min(self.snippet_pads[0], read_start)
+        pad_post = min(self.snippet_pads[1], self.num_frames - read_end)
+        padded_bp2 = recording_bp2.get_traces(channel_ids=segment_channel_ids, start_frame=read_start - pad_pre, end_frame=read_end + pad_post)
+        return trace_bp4, padded_bp2, pad_pre, margin_pre
+
+    def detect_segment(self, recording_bp2, recording_bp4, segment_channel_ids, segment_index, executor=None):
+        """Reads a segment once for the given channels and detects the spikes of each of them.
+
+        Returns:
+            dict: For each channel, the pieces of the segment for every std_min (see `detect_channel_segment`).
+        """
+        start_time, start_frame, end_frame = self.segment_frames(segment_index)
+        block_bp4, block_bp2, pad_pre, margin_pre = self.read_segment(recording_bp2, recording_bp4, segment_channel_ids, start_frame, end_frame)
+        if len(segment_channel_ids) == 1:
+            args = [(segment_channel_ids[0], block_bp4, block_bp2, pad_pre, margin_pre, end_frame - start_frame, start_time, start_frame)]
+        else:
+            args = [(channel_id, block_bp4[:, [i]], block_bp2[:, [i]], pad_pre, margin_pre, end_frame - start_frame, start_time, start_frame)
+                    for i, channel_id in enumerate(segment_channel_ids)]
+        if executor is None or len(args) == 1:
+            return {arg[0]: self.detect_channel_segment(*arg) for arg in args}
+        futures = [executor.submit(self.detect_channel_segment, *arg) for arg in args]
+        return {arg[0]: future.result() for arg, future in zip(args, futures)}
+
+    def detect_channel_segment(self, channel_id, trace_bp4, padded_bp2, pad_pre, margin_pre, segment_length, start_time, start_frame):
+        """Detects the spikes of one channel segment for every std_min."""
+        detect, w_pre, w_post, sample_ref = self.detect, self.w_pre, self.w_post, self.sample_ref
+        trace_bp2 = padded_bp2[pad_pre:pad_pre + len(trace_bp4)]
+        noise = self.estimate_noise(trace_bp4[margin_pre:margin_pre + segment_length]) if self.noise_levels is None else self.noise_levels[channel_id]
+        candidates = find_threshold_crossings(trace_bp4, self.std_mins[0] * noise / 0.6745, detect, w_pre, w_post, sample_ref)
+
+        pieces = {}
+        for stdmin in self.std_mins:
+            thr = stdmin * noise / 0.6745
+            thrmax = self.stdmax * thr 
+            xaux = filter_threshold_crossings(trace_bp4, candidates, thr, detect) if stdmin != self.std_mins[0] else candidates
+            index = self.select_spikes(trace_bp2, xaux, thrmax, self.ref, sample_ref, w_pre, w_post)
+            if self.margin:
+                # The spikes in the margins belong to the neighbouring segments
+                index = index[(index >= margin_pre) & (index < margin_pre + segment_length)]
+
+            spike_times = (np.array(index - margin_pre) / self.sr + start_time) * 1000
+            snippets = None
+            if self.snippet_window is not None:
+                indices = self.snippet_offsets + (np.asarray(index, dtype=int)[:, np.newaxis] + pad_pre)
+                snippets = np.take(padded_bp2, indices, axis=0, mode='clip').reshape(len(index), -1)
+            pieces[stdmin] = (spike_times, index - margin_pre + start_frame, thr, snippets)
+        return pieces
+
+    def merge_segments(self, segment_pieces):
+        """Concatenates the spikes detected in the segments of a channel, for every std_min."""
+        results = {}
+        for stdmin in self.std_mins:
+            pieces = [segment[stdmin] for segment in segment_pieces]
+            result = {
+                'spikes': np.concatenate([piece[0] for piece in pieces]),
+                'thresholds': np.array([piece[2] for piece in pieces]),
+                'indexes': np.concatenate([piece[1] for piece in pieces]),
+                'segments': np.repeat(np.arange(len(pieces)), [len(piece[1]) for piece in pieces]),
+            }
+            results[stdmin] = (result, np.concatenate([piece[3] for piece in pieces])) if self.snippet_window is not None else result
+        return results
+
+    def sweep(self, channel_results):
+        """Gathers the merged results of the channels in a SpikeTable for every std_min."""
+        sweep = {}
+        for stdmin in self.std_mins:
+            results = {channel_id: result[stdmin] for channel_id, result in channel_results.items()}
+            if self.snippet_window is not None:
+                snippets = {channel_id: result[1] for channel_id, result in results.items()}
+                results = {channel_id: result[0] for channel_id, result in results.items()}
+                sweep[stdmin] = (SpikeTable.from_results(results), snippets)
             else:
-                raise ValueError(f"Invalid value {detect} for argument 'detect'. Must be 'neg', 'pos', or 'both'.")
+                sweep[stdmin] = SpikeTable.from_results(results)
+        return sweep
 
-            xaux0 = 0
-            index = []
-            for i in range(len(xaux)):
-                if xaux[i] >= xaux0 + ref:
-                    iaux = np.argmin(trace_bp2[xaux[i]: xaux[i] + int(sample_ref)-1])
-                    # Check and eliminate artifacts
-                    if np.max(np.abs(trace_bp2[xaux[i] - w_pre: xaux[i] + w_post])) < thrmax:
-                        index.append(iaux + xaux[i])
-                        xaux0 = index[-1]
 
-            spike_times = (np.array(index) / sr + start_time) * 1000
+_segment_worker = {}
 
-            all_spikes.extend(spike_times)
-            indexes.extend(index)
-            thresholds.append(thr)
 
-        return {'spikes': np.array(all_spikes), 'thresholds': np.array(thresholds), 'indexes': np.array(indexes)}
+def init_segment_worker(detector, recording_bp2, recording_bp4):
+    """Keeps the detector and the recordings in a worker process, so tasks do not carry them."""
+    _segment_worker.update(detector=detector, recording_bp2=recording_bp2, recording_bp4=recording_bp4)
 
-    # Use ThreadPoolExecutor for parallel processing
-    with ThreadPoolExecutor() as executor:
-        # Submit tasks for each channel to the ThreadPoolExecutor
-        futures = [executor.submit(process_channel, channel_id) for channel_id in channel_ids]
 
-        # Collect the results for each channel as they become available
-        results = {channel_id: future.result() for channel_id, future in zip(channel_ids, futures)}
+def detect_segment_task(segment_channel_ids, segment_index):
+    """Detects one segment of the given channels in a worker process."""
+    detector = _segment_worker['detector']
+    return detector.detect_segment(_segment_worker['recording_bp2'], _segment_worker['recording_bp4'], segment_channel_ids, segment_index)
+
+
+def block_channel_groups(channel_ids, channel_groups=None):
+    """Returns the groups of channels read together in 'block' read mode.
+
+    Args:
+        channel_ids: The channels to detect.
+        channel_groups: Optional list of lists of channel ids, e.g. the channels of each bundle.
+                        Channels in no group are read together as one more group. Without
+                        groups, all channels are read together.
+
+    Returns:
+        list: The non-empty groups, each a list of channel ids.
+    """
+    channel_ids = list(channel_ids)
+    if channel_groups is None:
+        return [channel_ids] if channel_ids else []
+    remaining = set(channel_ids)
+    groups = []
+    for group in channel_groups:
+        group = [channel_id for channel_id in group if channel_id in remaining]
+        remaining.difference_update(group)
+        if group:
+            groups.append(group)
+    ungrouped = [channel_id for channel_id in channel_ids if channel_id in remaining]
+    if ungrouped:
+        groups.append(ungrouped)
+    return groups
+
 
-    return results
+def bundle_channel_groups(bundle_dict):
+    """Returns the channel ids of each bundle of a bundle dictionary, for `detect_spikes`."""
+    return [[info['channel_id'] for info in channel_info_list] for channel_info_list in bundle_dict.values()]
@@ -0,0 +1,93 @@
+# spike_table.py
+from collections.abc import Mapping
+import numpy as np
+
+
+def cluster_class_labels(labels, keep=None, unassigned=9999, removed=500):
+    """Returns the label of every detected spike of a channel, as saved in 'cluster_class'.
+
+    Args:
+        labels (ndarray): The cluster labels of the clustered spikes (the kept ones, with a keep mask).
+        keep (ndarray): Optional boolean mask of the spikes kept by artifacts removal.
+        unassigned (int): Label of the clustered spikes in no cluster (label 0).
+        removed (int): Label of the spikes removed as artifacts.
+    """
+    labels = np.asarray(labels)
+    class_labels = np.where(labels == 0, unassigned, labels)
+    if keep is None:
+        return class_labels
+    keep = np.asarray(keep, dtype=bool)
+    all_labels = np.full(len(keep), removed, dtype=class_labels.dtype if len(class_labels) else int)
+    all_labels[keep] = class_labels
+    return all_labels
+
+
+class SpikeTable(Mapping):
+    """The detected spikes of all channels, in contiguous columns keyed by sample index.
+
+    Each row is a spike. The rows of a channel are contiguous and in time order, and the
+    columns are:
+        - channel: position of the spike's channel in `channel_ids`
+        - index: sample index of the spike in the recording
+        - time: spike time in milliseconds, as computed by the detection
+        - segment: the detection segment the spike was found in
+
+    The table is also a read-only mapping from each channel id to the spike detection
+    results of that channel ({'spikes', 'indexes', 'thresholds', 'segments'}), so it can be
+    passed wherever per-channel results are expected.
+
+    Args:
+        channel_ids (list): The channel ids, in row order.
+        counts (ndarray): Number of spikes of each channel.
+        index, time, segment (ndarray): The columns of all the rows.
+        thresholds (dict): The detection threshold of each segment, per channel.
+    """
+
+    def __init__(self, channel_ids, counts, index, time, segment, thresholds):
+        self.channel_ids = list(channel_ids)
+        self._rows = {channel_id: position for position, channel_id in enumerate(self.channel_ids)}
+        self.offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+        self.channel = np.repeat(np.arange(len(self.channel_ids), dtype=np.int32), counts)
+        self.index = np.asarray(index, dtype=np.int64)
+        self.time = np.asarray(time, dtype=np.float64)
+        self.segment = np.asarray(segment, dtype=np.int32)
+        self.thresholds = thresholds
+
+    @classmethod
+    def from_results(cls, results):
+        """Builds a table from per-channel spike detection results (or returns it if it is one)."""
+        if isinstance(results, SpikeTable):
+            return results
+        channel_ids = list(results.keys())
+
+        def column(name, dtype):
+            arrays = [np.asarray(results[channel_id].get(name, np.zeros(len(results[channel_id]['indexes']))), dtype=dtype)
+                      for channel_id in channel_ids]
+            return np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+
+        counts = [len(results[channel_id]['indexes']) for channel_id in channel_ids]
+        return cls(channel_ids, counts, column('indexes', np.int64), column('spikes', np.float64), column('segments', np.int32),
+                   {channel_id: results[channel_id]['thresholds'] for channel_id in channel_ids})
+
+    def rows(self, channel_id):
+        """Returns the slice of the rows of a channel."""
+        position = self._rows[channel_id]
+        return slice(self.offsets[position], self.offsets[position + 1])
+
+    def __getitem__(self, channel_id):
+        rows = self.rows(channel_id)
+        return {
+            'spikes': self.time[rows],
+            'thresholds': self.thresholds[channel_id],
+            'indexes': self.index[rows],
+            'segments': self.segment[rows],
+        }
+
+    def __iter__(self):
+        return iter(self.channel_ids)
+
+    def __len__(self):
+        return len(self.channel_ids)
+
+    def __contains__(self, channel_id):
+        return channel_id in self._rows
@@ -0,0 +1,186 @@
+# stage_cache.py
+import hashlib
+import json
+import os
+import numpy as np
+import yaml
+
+
+def load_stage_cache_config():
+    file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+    with open(file_path, 'r') as config_file:
+        config = yaml.safe_load(config_file)
+        return config['pipeline']
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            # The bytes of an object array are pointers, which change from run to run
+            return json.dumps(value.tolist(), sort_keys=True, default=_json_default)
+        return hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+    if isinstance(value, np.generic):
+        return value.item()
+    return repr(value)
+
+
+def source_paths(value, key=''):
+    """Returns the existing files and folders named in the arguments of a recording description."""
+    if isinstance(value, dict):
+        return [path for name, item in value.items() for path in source_paths(item, str(name))]
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in source_paths(item, key)]
+    # Only the arguments named like paths, so that e.g. a channel id '0' is not taken for a file
+    if isinstance(value, (str, os.PathLike)) and any(word in key.lower() for word in ('path', 'file', 'folder', 'dir')):
+        if os.path.exists(value):
+            return [os.path.abspath(value)]
+    return []
+
+
+def source_stats(paths):
+    """Returns the size and modification time of each file, and of every file in each folder."""
+    stats = {}
+    for path in paths:
+        files = [path] if os.path.isfile(path) else [os.path.join(folder, file_name)
+                                                     for folder, _, file_names in os.walk(path) for file_name in file_names]
+        for file_name in files:
+            stat = os.stat(file_name)
+            stats[file_name] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+def recording_identity(recording):
+    """Returns a hash identifying a recording and the preprocessing applied to it.
+
+    It covers the spikeinterface description of the recording (class and arguments,
+    recursively, which include the file paths and filter parameters) along with its
+    number of frames, sampling frequency and channel ids. The size and modification time
+    of the source files are included too, so a file overwritten in place at the same path
+    gets a new identity.
+    """
+    description = recording.to_dict(recursive=True)
+    identity = {
+        'class': description.get('class'),
+        'kwargs': description.get('kwargs'),
+        'num_frames': recording.get_num_frames(),
+        'sampling_frequency': recording.get_sampling_frequency(),
+        'channel_ids': list(recording.get_channel_ids()),
+        'sources': source_stats(source_paths(description.get('kwargs'))),
+    }
+    text = json.dumps(identity, sort_keys=True, default=_json_default)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def code_version(*module_names):
+    """Returns a hash of the source of the given pywaveclus modules."""
+    digest = hashlib.sha256()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for module_name in module_names:
+        with open(os.path.join(folder, f'{module_name}.py'), 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def stage_key(stage, config_section, upstream_key, *module_names):
+    """Returns the cache key of a pipeline stage.
+
+    Args:
+        stage (str): Name of the stage.
+        config_section: The configuration the stage depends on (any JSON-able value).
+        upstream_key (str): Key of the stage it consumes, or the recording identity for the first stage.
+        module_names (str): The pywaveclus modules implementing the stage.
+
+    Returns:
+        str: A hex digest that changes whenever any of its inputs changes.
+    """
+    text = json.dumps([stage, config_section, upstream_key, code_version(*module_names)], sort_keys=True, default=_json_default)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class StageCache:
+    """On-disk, content-addressed cache of per-channel stage results.
+
+    Each entry is a dictionary of arrays stored as `<cache_dir>/<key>/channel_<id>.npz`.
+    When the cache grows over `max_bytes`, the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key, channel_id):
+        return os.path.join(self.cache_dir, key, f'channel_{channel_id}.npz')
+
+    def load(self, key, channel_id):
+        """Returns the cached entry, or None if there is none."""
+        path = self._path(key, channel_id)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        with np.load(path, allow_pickle=True) as data:
+            return {name: data[name].item() if data[name].dtype == object and data[name].ndim == 0 else data[name]
+                    for name in data.files}
+
+    def save(self, key, channel_id, entry):
+        path = self._path(key, channel_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path[:-len(".npz")]}.tmp.npz'
+        np.savez(tmp_path, **entry)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in `max_bytes`."""
+        entries = []
+        for folder, _, files in os.walk(self.cache_dir):
+            for file_name in files:
+                path = os.path.join(folder, file_name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+def open_stage_cache():
+    """Returns the StageCache configured in the pipeline section, or None if it is disabled."""
+    config = load_stage_cache_config()
+    cache_dir = config.get('cache_dir', '')
+    if not cache_dir:
+        return None
+    return StageCache(cache_dir, config.get('cache_max_gb', 20) * 1024 ** 3)
+
+
+def cached_channels(cache, key, channel_ids, compute):
+    """Loads a per-channel stage from the cache, or computes and stores it.
+
+    Args:
+        cache (StageCache): The cache, or None to always compute.
+        key (str): Key of the stage.
+        channel_ids: The channels the stage produces.
+        compute (callable): Returns a dictionary mapping each channel id to a dictionary of arrays.
+
+    Returns:
+        dict: The entry of each channel.
+    """
+    if cache is None:
+        return compute()
+
+    entries = {channel_id: cache.load(key, channel_id) for channel_id in channel_ids}
+    if all(entry is not None for entry in entries.values()):
+        return entries
+
+    entries = compute()
+    for channel_id, entry in entries.items():
+        cache.save(key, channel_id, entry)
+    cache.evict()
+    return entries
+
+
+def cached_arrays(cache, key, channel_ids, compute):
+    """Like `cached_channels`, for stages that produce a single array per channel."""
+    entries = cached_channels(cache, key, channel_ids, lambda: {channel_id: {'data': value} for channel_id, value in compute().items()})
+    return {channel_id: entry['data'] for channel_id, entry in entries.items()}
@@ -0,0 +1,106 @@
+# temperature_plots.py
+import os
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+
+def use_agg_backend():
+    """Selects matplotlib's non-interactive backend, so rendering needs no display."""
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def render_temperature_plot(metadata, path, title=None):
+    """Renders the SPC temperature plot of one channel to an image file."""
+    use_agg_backend()
+    import matplotlib.pyplot as plt
+    from spclustering import plot_temperature_plot
+
+    fig, ax = plt.subplots()
+    plot_temperature_plot(metadata, ax=ax)
+    if title is not None:
+        ax.set_title(title)
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+
+def render_summary_grid(metadata, path, title=None):
+    """Renders the temperature plots of several channels in one grid figure.
+
+    Args:
+        metadata (dict): The SPC metadata of each channel.
+        path (str): Image file to write.
+        title (str): Title of the figure.
+    """
+    use_agg_backend()
+    import matplotlib.pyplot as plt
+    from spclustering import plot_temperature_plot
+
+    ncols = math.ceil(math.sqrt(len(metadata)))
+    nrows = math.ceil(len(metadata) / ncols)
+    fig, axes = plt.subplots(nrows, ncols, figsize=(4 * ncols, 3 * nrows), squeeze=False)
+    for ax, (channel_id, channel_metadata) in zip(axes.flat, metadata.items()):
+        plot_temperature_plot(channel_metadata, ax=ax)
+        ax.set_title(f'channel {channel_id}')
+    for ax in axes.flat[len(metadata):]:
+        ax.set_visible(False)
+    if title is not None:
+        fig.suptitle(title)
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+
+class TemperaturePlotter:
+    """Renders SPC temperature plots to image files in background processes.
+
+    Clustering only queues the metadata of each channel with `submit`, which returns at
+    once; a process pool with the non-interactive Agg backend renders
+    `<plot_dir>/channel_<id>.<format>`. `summarize` renders the plots of a group of
+    channels, e.g. a bundle, in one grid figure `<plot_dir>/bundle_<name>.<format>`.
+    `close` waits for all the images.
+
+    Args:
+        plot_dir (str): Folder of the images.
+        max_workers (int): Number of rendering processes.
+        image_format (str): Image file format, e.g. 'png' or 'svg'.
+    """
+
+    def __init__(self, plot_dir, max_workers=1, image_format='png'):
+        self.plot_dir = plot_dir
+        self.image_format = image_format
+        self.metadata = {}
+        self.futures = []
+        os.makedirs(plot_dir, exist_ok=True)
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, initializer=use_agg_backend)
+
+    def submit(self, channel_id, metadata):
+        """Queues the temperature plot of a channel, unless it was already queued."""
+        if channel_id in self.metadata:
+            return
+        self.metadata[channel_id] = metadata
+        path = os.path.join(self.plot_dir, f'channel_{channel_id}.{self.image_format}')
+        self.futures.append(self.executor.submit(render_temperature_plot, metadata, path, f'channel {channel_id}'))
+
+    def summarize(self, name, channel_ids):
+        """Queues a grid of the temperature plots of the given (already submitted) channels."""
+        metadata = {channel_id: self.metadata[channel_id] for channel_id in channel_ids if channel_id in self.metadata}
+        if not metadata:
+            return
+        path = os.path.join(self.plot_dir, f'bundle_{name}.{self.image_format}')
+        self.futures.append(self.executor.submit(render_summary_grid, metadata, path, f'bundle {name}'))
+
+    def close(self):
+        """Waits for all the queued plots and returns the paths of the images."""
+        try:
+            return [future.result() for future in self.futures]
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(cancel_futures=exc_info[0] is not None)
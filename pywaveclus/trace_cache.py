@@ -0,0 +1,38 @@
+# trace_cache.py
+import os
+import shutil
+from spikeinterface.core import load
+from .stage_cache import recording_identity
+
+
+def cached_recording(recording, cache_dir, chunk_duration='10s', profiler=None):
+    """Returns a memory-mapped float32 copy of a (filtered) recording, writing it on first use.
+
+    The traces are saved once as a spikeinterface binary folder in
+    `<cache_dir>/<recording identity>`. The identity hashes the paths, sizes and modification
+    times of the source files and the preprocessing (see `stage_cache.recording_identity`),
+    so a rerun on the same recording reuses the folder, and a changed source (even one
+    overwritten in place) or filter writes a new one. Reading the cached recording maps
+    the file, without filtering again.
+
+    Args:
+        recording: The recording to cache, e.g. the bp2 or bp4 recording.
+        cache_dir (str): Folder of the trace cache.
+        chunk_duration (str): Duration of the chunks computed and written at a time.
+        profiler (PipelineProfiler): Optional profiler that logs the writing of the cache.
+
+    Returns:
+        The cached recording.
+    """
+    folder = os.path.join(cache_dir, recording_identity(recording))
+    if not os.path.exists(folder):
+        # Write to a temporary folder first, so an interrupted run never leaves a partial cache
+        tmp_folder = f'{folder}.tmp'
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+        if profiler is not None:
+            profiler.log(f'caching the traces in {folder}...')
+        recording.save(format='binary', folder=tmp_folder, dtype='float32', chunk_duration=chunk_duration, progress_bar=False)
+        os.replace(tmp_folder, folder)
+    return load(folder)
+
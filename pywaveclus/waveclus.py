@@ -1,18 +1,30 @@
 import scipy.io as sio
 import numpy as np
 # WaveClus imports
-from WaveClus.pywaveclus.spike_detection import detect_spikes
-from WaveClus.pywaveclus.artifacts_removal import artifacts_removal_for_bundle
-from WaveClus.pywaveclus.feature_extraction import feature_extraction
-from WaveClus.pywaveclus.waveform_extraction import extract_waveforms
-from WaveClus.pywaveclus.clustering import SPC_clustering
+from .spike_detection import detect_spikes, load_spike_detection_config, bundle_channel_groups
+from .artifacts_removal import artifacts_removal_for_bundle
+from .feature_extraction import feature_extraction, load_feature_extraction_config
+from .waveform_extraction import extract_waveforms, detect_and_extract_waveforms, load_waveform_extraction_config
+from .clustering import SPC_clustering, load_clustering_config
+from .stage_cache import open_stage_cache, recording_identity, stage_key, cached_channels, cached_arrays
+from .scheduler import load_pipeline_config, sort_channels_in_pool, sort_channels_streaming
+from .columnar_output import save_channels_to_npy
+from .instrumentation import PipelineProfiler, load_instrumentation_config
+from .incremental import save_sorting_models, save_bundles, load_incremental_config
+from .trace_cache import cached_recording
+from .waveform_store import waveform_stores
+from .temperature_plots import TemperaturePlotter
+from .spike_table import SpikeTable, cluster_class_labels
 import os
+from contextlib import nullcontext
 import yaml
 
 
+# Modules of the spike detection, whose source is part of the cache keys
+DETECTION_MODULES = ('spike_detection', 'noise_estimation', 'spike_table')
 
 
-def spike_sorting_pipeline(recording, recording_bp2, recording_bp4, bundle_dict,artifact_removal=False, save_dir=None):
+def spike_sorting_pipeline(recording, recording_bp2, recording_bp4, bundle_dict,artifact_removal=False, save_dir=None, fused=False, run_name=None):
     """
     Perform the spike sorting pipeline.
 
@@ -21,75 +33,232 @@ def spike_sorting_pipeline(recording, recording_bp2, recording_bp4, bundle_dict,
         recording_bp2 (ndarray): Recording data after bandpass filter at 2Hz.
         recording_bp4 (ndarray): Recording data after bandpass filter at 4Hz.
         bundle_dict (dict): Dictionary containing parameters for artifacts removal.
+        fused (bool): If True, waveforms are cut during spike detection, so bp2 is read only once.
+        run_name (str): If given, the report is saved as pipeline_report_<run_name>.json, so
+                        several runs over parts of a recording can share `save_dir`.
+
+    If `cache_dir` is set in the pipeline section of config.yaml, the results of each stage are
+    cached there, and a rerun only recomputes the stages whose inputs, configuration or code changed.
+    The stage cache is only used when channels are sorted sequentially (`n_workers` 1, without
+    `streaming`); the process pool and streaming modes recompute every stage.
+    If `save_models` is set in the incremental section, the thresholds, features and cluster
+    templates of each channel are saved so `incremental.sort_new_chunk` can sort new data.
+    If `trace_cache_dir` is set, the bp2 and bp4 recordings are read from float32 copies
+    memory-mapped from that folder, written on the first run (see `trace_cache.cached_recording`).
+    If `streaming` is set, channels are sorted one at a time, or as many at once as fit in
+    `memory_budget_gb`, and released once saved (see `scheduler.sort_channels_streaming`).
+    If `plot_temperature` is set in the clustering section, the SPC temperature plots of each
+    channel and a grid per bundle are rendered to save_dir/temperature_plots by background
+    processes while clustering continues.
     
     Save:
 
     Returns:
-        None
+        dict: The timing and memory report of the pipeline stages (see `instrumentation.PipelineProfiler`),
+              also saved as pipeline_report.json (or pipeline_report_<run_name>.json) in `save_dir`
+              unless `report` is False in config.yaml.
     """
-    # Step 1: Spike Detection
-    print('start spike detection...')
-    spike_detection_results = detect_spikes(recording, recording_bp2, recording_bp4)
-    print('end spike detection!')
-    # Step 3: Extract Waveforms
-    print('start extract waveforms...')
-    waveforms = extract_waveforms(spike_detection_results, recording_bp2)
-    print('end extract waveforms!')
+    pipeline_config = load_pipeline_config()
+    profiler = open_profiler(save_dir)
+    trace_cache_dir = pipeline_config.get('trace_cache_dir', '')
+    if trace_cache_dir:
+        # Filter once into memory-mapped float32 files, which all stages then read
+        with profiler.stage('trace_cache'):
+            recording_bp2 = cached_recording(recording_bp2, trace_cache_dir, profiler=profiler)
+            recording_bp4 = cached_recording(recording_bp4, trace_cache_dir, profiler=profiler)
+    # The rendering processes are stopped even if a stage raises
+    with open_temperature_plotter(save_dir) as plotter:
+        sort_recording(recording, recording_bp2, recording_bp4, bundle_dict, artifact_removal, save_dir, fused, pipeline_config, profiler, plotter)
+        close_temperature_plotter(profiler, plotter, bundle_dict)
+    return save_report(profiler, save_dir, run_name)
+
+
+def sort_recording(recording, recording_bp2, recording_bp4, bundle_dict, artifact_removal, save_dir, fused, pipeline_config, profiler, plotter):
+    """Runs the stages of `spike_sorting_pipeline` in the configured mode and saves the channels."""
+    if load_incremental_config().get('save_models', False):
+        # sort_new_chunk removes the artifacts of new chunks as the models were built
+        save_bundles(save_dir, bundle_dict, artifact_removal)
+    n_workers = pipeline_config['n_workers']
+    if pipeline_config.get('cache_dir', '') and (pipeline_config.get('streaming', False) or n_workers != 1):
+        profiler.log('the stage cache is only used with n_workers 1 and streaming False, every stage is recomputed')
+    if pipeline_config.get('streaming', False):
+        # Each channel is extracted, featurized, clustered and saved, then released, within the memory budget
+        with profiler.stage('sort_channels_streaming'):
+            sort_channels_streaming(recording, recording_bp2, recording_bp4, bundle_dict, artifact_removal=artifact_removal, save_dir=save_dir,
+                                    n_workers=n_workers, memory_budget_gb=pipeline_config.get('memory_budget_gb', 4), profiler=profiler, plotter=plotter)
+        return
+    if n_workers != 1:
+        # Extraction, features, clustering and saving run per channel in a process pool
+        with profiler.stage('sort_channels_in_pool'):
+            sort_channels_in_pool(recording, recording_bp2, recording_bp4, bundle_dict, artifact_removal=artifact_removal, save_dir=save_dir, fused=fused, n_workers=n_workers, profiler=profiler, plotter=plotter)
+        return
+
+    cache = open_stage_cache()
+    if cache is not None:
+        identity = '-'.join(recording_identity(rec) for rec in (recording, recording_bp2, recording_bp4))
+        # The code version of a stage covers every pywaveclus module it imports; the fused
+        # detection is run by waveform_extraction
+        detection_modules = DETECTION_MODULES + (('waveform_extraction',) if fused else ())
+        detection_key = stage_key('detection', load_spike_detection_config(), identity, *detection_modules)
+        waveforms_key = stage_key('waveforms', load_waveform_extraction_config(), detection_key, *DETECTION_MODULES, 'waveform_extraction')
+    else:
+        detection_key = waveforms_key = None
+    channel_ids = recording.get_channel_ids()
+    # Channels of a bundle are read together in the 'block' read mode of spike detection
+    channel_groups = bundle_channel_groups(bundle_dict)
+    # Count the bytes read by the stages
+    recording_bp2 = profiler.counting(recording_bp2)
+    recording_bp4 = profiler.counting(recording_bp4)
+
+    def run_detection():
+        return cached_channels(cache, detection_key, channel_ids, lambda: detect_spikes(recording, recording_bp2, recording_bp4, channel_groups=channel_groups))
+
+    if fused:
+        # Step 1 and 3: Spike Detection and Extract Waveforms in one pass
+        fused_results = {}
+
+        def run_fused():
+            fused_results['detection'], fused_results['waveforms'] = detect_and_extract_waveforms(recording, recording_bp2, recording_bp4, channel_groups=channel_groups)
+            return fused_results['waveforms']
+
+        with profiler.stage('detect_and_extract_waveforms'):
+            waveforms = cached_arrays(cache, waveforms_key, channel_ids, run_fused)
+            spike_detection_results = fused_results.get('detection')
+            if spike_detection_results is None:
+                spike_detection_results = run_detection()
+            elif cache is not None:
+                cached_channels(cache, detection_key, channel_ids, lambda: spike_detection_results)
+        profiler.count_channels('detect_and_extract_waveforms', waveforms, 'waveforms')
+    else:
+        # Step 1: Spike Detection
+        with profiler.stage('detect_spikes'):
+            spike_detection_results = run_detection()
+        # Step 3: Extract Waveforms
+        with profiler.stage('extract_waveforms'):
+            waveforms = cached_arrays(cache, waveforms_key, channel_ids,
+                                      lambda: per_channel(profiler, 'extract_waveforms', spike_detection_results, lambda results: extract_waveforms(results, recording_bp2)))
+        profiler.count_channels('extract_waveforms', waveforms, 'waveforms')
+    # Cached detection results are per-channel dictionaries, gathered back in one table
+    spike_detection_results = SpikeTable.from_results(spike_detection_results)
+    profiler.count_channels('detect_and_extract_waveforms' if fused else 'detect_spikes',
+                            {channel_id: result['indexes'] for channel_id, result in spike_detection_results.items()}, 'spikes')
+    # The waveforms are extracted once; later stages use views of them
+    waveforms = waveform_stores(waveforms, spike_detection_results)
     if artifact_removal:
         # Step 2: Artifact Removal
-        print('start artifact removal...')
-        filtered_results,artifacts_times = artifacts_removal_for_bundle(spike_detection_results,bundle_dict)
-        print('end artifact removal!')
-        # Create a dictionary to store the filtered waveforms
-        filtered_waveforms = extract_waveforms(filtered_results, recording_bp2)
-        features = feature_extraction(filtered_waveforms)
-        print('start clustering...')
-        # Step 5: Clustering
-        labels, metadata = SPC_clustering(features)
-        print('end clustering!')
-        # Save data for each channel in a separate MATLAB file
-        for channel_id in labels.keys():
-            save_channel_data_to_mat_artifact(recording,channel_id, spike_detection_results, filtered_results,waveforms,filtered_waveforms,features, labels, save_dir=save_dir)
-
-
+        with profiler.stage('artifacts_removal_for_bundle'):
+            filtered_results,artifacts_times = artifacts_removal_for_bundle(spike_detection_results,bundle_dict,sr=recording.get_sampling_frequency())
+        profiler.count_channels('artifacts_removal_for_bundle', {channel_id: result['indexes'] for channel_id, result in filtered_results.items()}, 'spikes')
+        if cache is not None:
+            waveforms_key = stage_key('filtered_waveforms', bundle_dict, waveforms_key, 'artifacts_removal', 'spike_table', 'waveform_store')
+        # The filtered spikes are a subset of the detected ones, so their waveforms are a view of the same store
+        filtered_waveforms = {channel_id: waveforms[channel_id].select(result['keep']) for channel_id, result in filtered_results.items()}
     else:
-        # Step 4: Feature Extraction
-        print('start feature extraction')
-        features = feature_extraction(waveforms)
-        print('end feature extraction')
-        
-        print('start clustering')
-        # Step 5: Clustering
+        filtered_waveforms = waveforms
+
+    # Step 4: Feature Extraction
+    features_key = stage_key('features', load_feature_extraction_config(), waveforms_key, 'feature_extraction', 'waveform_store') if cache is not None else None
+
+    def run_feature_extraction():
+        # The feature model of each channel is kept with its features, so the incremental
+        # models reuse them instead of extracting the features again
+        feature_models = {}
+        features = per_channel(profiler, 'feature_extraction', filtered_waveforms, lambda channel_waveforms: feature_extraction(channel_waveforms, feature_models))
+        return {channel_id: {'data': channel_features, **{f'model_{name}': value for name, value in feature_models[channel_id].items()}}
+                for channel_id, channel_features in features.items()}
+
+    with profiler.stage('feature_extraction'):
+        feature_entries = cached_channels(cache, features_key, filtered_waveforms.keys(), run_feature_extraction)
+    features = {channel_id: entry['data'] for channel_id, entry in feature_entries.items()}
+    feature_models = {channel_id: {name[len('model_'):]: value for name, value in entry.items() if name.startswith('model_')}
+                      for channel_id, entry in feature_entries.items()}
+    profiler.count_channels('feature_extraction', features, 'features')
+
+    # Step 5: Clustering
+    clustering_key = stage_key('clustering', load_clustering_config(), features_key, 'clustering') if cache is not None else None
+
+    def run_clustering():
+        clustering_results = {}
+        for channel_id, feature in features.items():
+            with profiler.stage('SPC_clustering', channel_id):
+                labels, metadata = SPC_clustering({channel_id: feature}, plotter, profiler)
+            clustering_results[channel_id] = {'labels': labels[channel_id], 'metadata': metadata[channel_id]}
+        return clustering_results
+
+    with profiler.stage('SPC_clustering'):
+        clustering_results = cached_channels(cache, clustering_key, features.keys(), run_clustering)
+    labels = {channel_id: result['labels'] for channel_id, result in clustering_results.items()}
+    metadata = {channel_id: result['metadata'] for channel_id, result in clustering_results.items()}
+    if plotter is not None:
+        # Channels loaded from the cache were not plotted during clustering
+        for channel_id, channel_metadata in metadata.items():
+            plotter.submit(channel_id, channel_metadata)
+
+    with profiler.stage('save'):
+        if pipeline_config.get('output_format', 'mat') == 'npy':
+            # Save data for each channel in a folder of .npy columns
+            save_channels_to_npy(recording, spike_detection_results, waveforms, features, labels, save_dir,
+                                 filtered_results=filtered_results if artifact_removal else None)
+        else:
+            # Save data for each channel in a separate MATLAB file
+            for channel_id in labels.keys():
+                if artifact_removal:
+                    save_channel_data_to_mat_artifact(recording,channel_id, spike_detection_results, filtered_results,waveforms,filtered_waveforms,features, labels, save_dir=save_dir)
+                else:
+                    save_channel_data_to_mat(recording,channel_id, spike_detection_results, waveforms, features, labels, save_dir=save_dir)
+
+    if load_incremental_config().get('save_models', False):
+        # Models to sort new chunks of the recording with incremental.sort_new_chunk
+        with profiler.stage('save_models'):
+            save_sorting_models(save_dir, spike_detection_results, features, feature_models, labels)
+
+
+def per_channel(profiler, stage, inputs, func):
+    """Calls `func` on a single-channel dictionary for each channel of `inputs`, timing each call.
 
-        labels, metadata = SPC_clustering(features)
-        
-        print('end clustering')
-        # Save data for each channel in a separate MATLAB file
-        for channel_id in labels.keys():
-            save_channel_data_to_mat(recording,channel_id, spike_detection_results, waveforms, features, labels, save_dir=save_dir)
+    Returns:
+        dict: The merged outputs of `func`.
+    """
+    outputs = {}
+    for channel_id, value in inputs.items():
+        with profiler.stage(stage, channel_id):
+            outputs[channel_id] = func({channel_id: value})[channel_id]
+    return outputs
 
 
+def open_profiler(save_dir):
+    """Returns the PipelineProfiler configured in the pipeline section of config.yaml."""
+    config = load_instrumentation_config()
+    profile_dir = os.path.join(save_dir, 'profiles') if config.get('cprofile', False) else None
+    return PipelineProfiler(trace_memory=config.get('trace_memory', False), profile_dir=profile_dir)
 
 
-# This function add removed spikes that was detected as an artifact to the spike_time_label_mapping
-def add_missing_spikes(channel_id, spike_detection_results, filtered_results, spike_time_label_mapping):
-    # Create a set of all the spikes from spike_detection_results
-    all_spikes_set = set(spike_detection_results[channel_id]['spikes'])
+def open_temperature_plotter(save_dir):
+    """Returns the TemperaturePlotter configured in the clustering section, or a context of None without temperature plots."""
+    config = load_clustering_config()
+    if not config.get('plot_temperature', False):
+        return nullcontext()
+    return TemperaturePlotter(os.path.join(save_dir, 'temperature_plots'), max_workers=config.get('plot_workers', 1),
+                              image_format=config.get('plot_format', 'png'))
 
-    # Create a set of all the spikes present in spike_time_label_mapping
-    existing_spikes_set = set(spike for _, spike in spike_time_label_mapping)
 
-    # Find the missing spikes using set difference
-    missing_spikes = all_spikes_set - existing_spikes_set
+def close_temperature_plotter(profiler, plotter, bundle_dict):
+    """Queues the summary grid of each bundle and waits for the remaining temperature plots."""
+    if plotter is None:
+        return
+    with profiler.stage('temperature_plots'):
+        for bundle_name, channel_info_list in bundle_dict.items():
+            plotter.summarize(bundle_name, [channel_info['channel_id'] for channel_info in channel_info_list])
+        plotter.close()
 
-    # Create a list with label 500 for the missing spikes
-    missing_spikes_list = [(500, spike) for spike in missing_spikes]
 
-    # Extend the original spike_time_label_mapping with the missing spikes
-    spike_time_label_mapping.extend(missing_spikes_list)
-    spike_time_label_mapping.sort(key=lambda x: x[1])
+def save_report(profiler, save_dir, run_name=None):
+    """Saves the profiler report as pipeline_report[_<run_name>].json in `save_dir`, if enabled, and returns it."""
+    if load_instrumentation_config().get('report', True):
+        file_name = 'pipeline_report.json' if run_name is None else f'pipeline_report_{run_name}.json'
+        profiler.save(os.path.join(save_dir, file_name))
+    return profiler.report()
 
-    return spike_time_label_mapping
 
 
 
@@ -155,11 +324,11 @@ def save_channel_data_to_mat(recording,channel_id, spike_detection_results, wave
     file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
     with open(file_path, 'r') as config_file:
         config = yaml.safe_load(config_file)
-    spike_time_label_mapping = [(9999 if labels[channel_id][i] == 0 else labels[channel_id][i], spike_detection_results[channel_id]['spikes'][i]) for i in range(len(spike_detection_results[channel_id]['spikes']))]
+    spike_time_label_mapping = np.column_stack([cluster_class_labels(labels[channel_id]), spike_detection_results[channel_id]['spikes']])
     config['sr'] = recording.get_sampling_frequency()
     data_dict = {
         'Spike_Time': spike_detection_results[channel_id]['spikes'],
-        'spikes': waveforms[channel_id],
+        'spikes': np.asarray(waveforms[channel_id]),
         'inspk': features[channel_id],
         'Label': labels[channel_id],
         'Spike_Time_Waveform': spike_time_waveform_mapping,
@@ -228,13 +397,13 @@ def save_channel_data_to_mat_artifact(recording,channel_id, spike_detection_resu
     file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
     with open(file_path, 'r') as config_file:
         config = yaml.safe_load(config_file)
-    spike_time_label_mapping = [(1000 if labels[channel_id][i] == 0 else labels[channel_id][i], filtered_spikes[channel_id]['spikes'][i]) for i in range(len(filtered_spikes[channel_id]['spikes']))]
-    spike_time_label_mapping = add_missing_spikes(channel_id, spike_detection_results, filtered_spikes, spike_time_label_mapping)
-    labels_only = [item[0] for item in spike_time_label_mapping]
+    # Spikes removed as artifacts get label 500, found from the keep mask instead of matching spike times
+    labels_only = cluster_class_labels(labels[channel_id], filtered_spikes[channel_id]['keep'], unassigned=1000)
+    spike_time_label_mapping = np.column_stack([labels_only, spike_detection_results[channel_id]['spikes']])
     config['sr'] = recording.get_sampling_frequency()
     data_dict = {
         'Spike_Time': spike_detection_results[channel_id]['spikes'],
-        'spikes': waveforms[channel_id],
+        'spikes': np.asarray(waveforms[channel_id]),
         'inspk': features[channel_id],
         'Label': labels_only,
         'Spike_Time_Waveform': spike_time_waveform_mapping,
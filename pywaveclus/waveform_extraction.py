@@ -2,6 +2,9 @@ import yaml
 import numpy as np
 from scipy.interpolate import splrep, splev
 import os 
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from .spike_detection import detect_spikes
 
 def load_waveform_extraction_config(config_file='config.yaml'):
     """Load waveform extraction configuration from a YAML file.
@@ -36,48 +39,253 @@ def extract_waveforms(results, recording_bp2, config_file='config.yaml'):
     w_pre = config.get('w_pre', 20)
     w_post = config.get('w_post', 44)
     int_factor = config.get('int_factor', 5)
+    chunk_duration = config.get('chunk_duration', 0) or None
+    dtype = precision_dtype(config)
+    segment_workers = config.get('segment_workers', 1)
+    if segment_workers != 1:
+        return extract_waveforms_by_segment(results, recording_bp2, detect, w_pre, w_post, int_factor, dtype, segment_workers)
 
     spikes_waveforms = {}
     for channel_id, result in results.items():
-        spikes_waveforms[channel_id] = extract_waveforms_for_channel(result, recording_bp2, channel_id, detect, w_pre, w_post, int_factor)
+        spikes_waveforms[channel_id] = extract_waveforms_for_channel(result, recording_bp2, channel_id, detect, w_pre, w_post, int_factor, chunk_duration, dtype)
 
     return spikes_waveforms
 
 
-def extract_waveforms_for_channel(result, recording_bp2, channel_id, detect, w_pre, w_post, int_factor):
-    spikes_times = result['spikes']
-    indexes = result['indexes']
+def extract_waveforms_by_segment(results, recording_bp2, detect, w_pre, w_post, int_factor, dtype=np.float64, segment_workers=0):
+    """Extracts the waveforms of every (channel, detection segment) pair in a process pool.
+
+    The spikes of a channel are split by the detection segment they were found in (its
+    'segments', when the results have them), and each worker reads only the span of the
+    trace around the spikes of its segment. The waveforms of each channel are merged back in
+    the order of its spikes, and are the same as `extract_waveforms_for_channel` gives.
+
+    Args:
+        results (dict): The spike detection results of each channel.
+        recording_bp2: The recording object for the channels' bandpass 2 data.
+        detect, w_pre, w_post, int_factor: As in `align_spikes`.
+        dtype: The dtype of the waveforms.
+        segment_workers (int): Number of worker processes, 0 for one per CPU.
+
+    Returns:
+        dict: The waveforms of each channel.
+    """
+    snippet_dtype = None if dtype == np.float64 else dtype
+    tasks = []
+    for channel_id, result in results.items():
+        indexes = np.asarray(result['indexes'], dtype=int)
+        segments = np.asarray(result.get('segments', np.zeros(len(indexes), dtype=int)))
+        # The spikes are in time order, so those of a segment are contiguous
+        for segment_indexes in np.split(indexes, np.flatnonzero(np.diff(segments)) + 1):
+            tasks.append((channel_id, segment_indexes))
 
-    xf = recording_bp2.get_traces(channel_ids=[channel_id], start_frame=0, end_frame=recording_bp2.get_num_frames())
+    with ProcessPoolExecutor(max_workers=segment_workers if segment_workers > 0 else os.cpu_count(),
+                             initializer=init_extraction_worker, initargs=(recording_bp2,)) as executor:
+        futures = [executor.submit(extract_segment_task, channel_id, segment_indexes, detect, w_pre, w_post, int_factor, snippet_dtype, dtype)
+                   for channel_id, segment_indexes in tasks]
+        pieces = {channel_id: [] for channel_id in results.keys()}
+        for (channel_id, _), future in zip(tasks, futures):
+            pieces[channel_id].append(future.result())
 
     ls = w_pre + w_post
-    nspk = len(spikes_times)
-    spikes = np.zeros((nspk, ls + 4))
+    return {channel_id: np.concatenate(channel_pieces) if channel_pieces else np.zeros((0, ls), dtype=dtype)
+            for channel_id, channel_pieces in pieces.items()}
+
+
+_extraction_worker = {}
+
+
+def init_extraction_worker(recording_bp2):
+    """Keeps the recording in a worker process, so tasks do not carry it."""
+    _extraction_worker['recording_bp2'] = recording_bp2
+
+
+def extract_segment_task(channel_id, indexes, detect, w_pre, w_post, int_factor, snippet_dtype, dtype):
+    """Reads the snippets of a segment's spikes, from the span of the trace they cover, and aligns them."""
+    recording_bp2 = _extraction_worker['recording_bp2']
+    offsets = np.arange(-w_pre - 2, w_post + 2)
+    if len(indexes):
+        read_start = max(int(indexes.min()) - w_pre - 2, 0)
+        read_end = min(int(indexes.max()) + w_post + 2, recording_bp2.get_num_frames())
+        xf = recording_bp2.get_traces(channel_ids=[channel_id], start_frame=read_start, end_frame=read_end)
+        spikes = np.take(xf, offsets + (indexes[:, np.newaxis] - read_start), axis=0, mode='clip').reshape(len(indexes), -1)
+        if snippet_dtype is not None:
+            spikes = spikes.astype(snippet_dtype, copy=False)
+    else:
+        spikes = np.zeros((0, len(offsets)), dtype=snippet_dtype)
+    return align_spikes(spikes, detect, w_pre, w_post, int_factor, dtype=dtype)
+
+
+def detect_and_extract_waveforms(recording, recording_bp2, recording_bp4, config_file='config.yaml', channel_groups=None):
+    """Detects spikes and extracts their waveforms in a single pass over bp2.
+
+    The raw snippets are cut while each detection segment is in memory, so bp2 is
+    read once instead of once for detection and once more for extraction.
+
+    Args:
+        recording: The recording object to process.
+        recording_bp2: The recording object for the channels' bandpass 2 data.
+        recording_bp4: The recording object for the channels' bandpass 4 data.
+        config_file (str): Path to the YAML configuration file. Default is 'config.yaml'.
+        channel_groups: Optional groups of channels read together, as in `detect_spikes`.
+
+    Returns:
+        tuple: The spike detection results, as returned by `detect_spikes`, and a dictionary
+               where keys are the channel ids and values are the extracted waveforms.
+    """
+    config = load_waveform_extraction_config(config_file)
+    detect = config.get('detect_method', 'neg')
+    w_pre = config.get('w_pre', 20)
+    w_post = config.get('w_post', 44)
+    int_factor = config.get('int_factor', 5)
+    dtype = precision_dtype(config)
+
+    results, snippets = detect_spikes(recording, recording_bp2, recording_bp4, snippet_window=(w_pre, w_post), channel_groups=channel_groups)
+
+    spikes_waveforms = {}
+    for channel_id, spikes in snippets.items():
+        spikes_waveforms[channel_id] = align_spikes(spikes, detect, w_pre, w_post, int_factor, dtype=dtype)
+
+    return results, spikes_waveforms
+
+
+def precision_dtype(config):
+    """Returns the dtype of the waveforms set by `precision` in the waveform extraction config.
+
+    'float64' (the default) keeps the previous behavior, 'float32' keeps the snippets, the
+    upsampled buffers and the waveforms, and so the features computed from them, in float32.
+    """
+    precision = config.get('precision', 'float64')
+    if precision not in ('float64', 'float32'):
+        raise ValueError(f"Invalid value {precision} for argument 'precision'. Must be 'float64' or 'float32'.")
+    return np.dtype(precision)
+
+
+def read_spike_snippets(recording_bp2, channel_id, indexes, w_pre, w_post, chunk_duration=None, dtype=None):
+    """Reads the raw bp2 snippets around each spike of a channel.
+
+    Args:
+        recording_bp2: The recording object for the channels' bandpass 2 data.
+        channel_id: The channel to read.
+        indexes (ndarray): Sample indexes of the spikes in the recording.
+        w_pre (int): Pre-event window size.
+        w_post (int): Post-event window size.
+        chunk_duration (float): If given, the trace is read in chunks of this many seconds
+                                (plus the snippet margins) so that memory is bounded by the chunk
+                                size instead of the recording length. If None, the whole channel
+                                is read at once.
+        dtype: The dtype of the snippets. If None, that of the traces when they are read at once
+               and float64 when they are read in chunks.
+
+    Returns:
+        ndarray: Array of shape (nspk, w_pre + w_post + 4) with the snippets, in the order of `indexes`.
+    """
+    indexes = np.asarray(indexes, dtype=int)
+    nspk = len(indexes)
+    offsets = np.arange(-w_pre - 2, w_post + 2)
+    num_frames = recording_bp2.get_num_frames()
+
+    if chunk_duration is None:
+        xf = recording_bp2.get_traces(channel_ids=[channel_id], start_frame=0, end_frame=num_frames)
+        indices = offsets + indexes[:, np.newaxis]
+        spikes = np.take(xf, indices, axis=0).reshape(nspk, -1)
+        return spikes if dtype is None else spikes.astype(dtype, copy=False)
+
+    chunk_size = max(int(chunk_duration * recording_bp2.get_sampling_frequency()), 1)
+    spikes = np.zeros((nspk, len(offsets)), dtype=dtype)
+    order = np.argsort(indexes, kind='stable')
+    sorted_indexes = indexes[order]
+
+    for chunk_start in range(0, num_frames, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, num_frames)
+        first, last = np.searchsorted(sorted_indexes, [chunk_start, chunk_end], side='left')
+        if first == last:
+            continue
+        # Read the chunk with enough margin for the snippets of spikes close to its edges
+        read_start = max(chunk_start - w_pre - 2, 0)
+        read_end = min(chunk_end + w_post + 2, num_frames)
+        xf = recording_bp2.get_traces(channel_ids=[channel_id], start_frame=read_start, end_frame=read_end)
+        indices = offsets + (sorted_indexes[first:last, np.newaxis] - read_start)
+        spikes[order[first:last]] = np.take(xf, indices, axis=0, mode='clip').reshape(last - first, -1)
+
+    return spikes
+
+
+def extract_waveforms_for_channel(result, recording_bp2, channel_id, detect, w_pre, w_post, int_factor, chunk_duration=None, dtype=np.float64):
+    indexes = result['indexes']
+    snippet_dtype = None if dtype == np.float64 else dtype
+    spikes = read_spike_snippets(recording_bp2, channel_id, indexes, w_pre, w_post, chunk_duration, snippet_dtype)
+
+    return align_spikes(spikes, detect, w_pre, w_post, int_factor, dtype=dtype)
 
-    indices = np.arange(-w_pre - 2, w_post + 2) + indexes[:, np.newaxis]
-    spikes = np.take(xf, indices, axis=0).reshape(nspk, -1)
 
+@lru_cache(maxsize=None)
+def spline_interpolation_matrix(w_pre, w_post, int_factor, dtype='float64'):
+    """Builds the linear operator of the cubic spline upsampling of a spike snippet.
+
+    With a fixed sample grid, `splrep`/`splev` interpolation is linear in the sample
+    values, so upsampling a snippet is a product with a fixed matrix. Its columns are
+    the interpolation of the unit snippets.
+
+    Args:
+        w_pre (int): Pre-event window size.
+        w_post (int): Post-event window size.
+        int_factor (int): Upsampling factor.
+        dtype (str): The dtype of the matrix.
+
+    Returns:
+        ndarray: Read-only matrix of shape (len(ints), w_pre + w_post + 4).
+    """
+    n_samples = w_pre + w_post + 4
+    s = np.arange(n_samples)
+    ints = np.arange(0, n_samples, 1 / int_factor)
+    operator = np.empty((len(ints), n_samples))
+    for j, unit in enumerate(np.eye(n_samples)):
+        operator[:, j] = splev(ints, splrep(s, unit))
+    operator = operator.astype(dtype, copy=False)
+    operator.flags.writeable = False
+    return operator
+
+
+def align_spikes(spikes, detect, w_pre, w_post, int_factor, batch_size=65536, dtype=np.float64):
+    """Upsamples raw spike snippets and realigns them on their interpolated peak.
+
+    Args:
+        spikes (ndarray): Raw snippets of shape (nspk, w_pre + w_post + 4).
+        detect (str): The detection method ('neg', 'pos', 'both').
+        w_pre (int): Pre-event window size.
+        w_post (int): Post-event window size.
+        int_factor (int): Upsampling factor.
+        batch_size (int): Number of spikes upsampled at once, bounding the size of the
+                          upsampled buffer.
+        dtype: The dtype of the upsampled buffer and of the waveforms.
+
+    Returns:
+        ndarray: Aligned waveforms of shape (nspk, w_pre + w_post).
+    """
+    ls = w_pre + w_post
+    nspk = len(spikes)
     extra = (spikes.shape[1] - ls) // 2
-    s = np.arange(spikes.shape[1])
-    ints = np.arange(0, spikes.shape[1], 1 / int_factor)
-    spikes_waveforms = np.zeros((nspk, ls))
+    spikes_waveforms = np.zeros((nspk, ls), dtype=dtype)
 
     if nspk > 0:
-        intspikes = np.empty((nspk, len(ints)))
-        for i in range(nspk):
-            tck = splrep(s, spikes[i, :])
-            intspikes[i, :] = splev(ints, tck)
-
-        if detect == 'pos':
-            iaux = intspikes[:, int((w_pre+extra-1)*int_factor):int((w_pre+extra+1)*int_factor)].argmax(axis=1)
-        elif detect == 'neg':
-            iaux = intspikes[:, int((w_pre+extra-1)*int_factor):int((w_pre+extra+1)*int_factor)].argmin(axis=1)
-        elif detect == 'both':
-            iaux = np.abs(intspikes[:, int((w_pre+extra-1)*int_factor):int((w_pre+extra+1)*int_factor)]).argmax(axis=1)
-
-        iaux = iaux + (w_pre+extra-1)*int_factor - 1
-
-        for i in range(nspk):
-            spikes_waveforms[i, :] = intspikes[i, int(iaux[i]-w_pre*int_factor+int_factor):int(iaux[i]+w_post*int_factor+1):int_factor]
+        operator = spline_interpolation_matrix(w_pre, w_post, int_factor, np.dtype(dtype).name)
+        peak_start = int((w_pre+extra-1)*int_factor)
+        peak_end = int((w_pre+extra+1)*int_factor)
+        offsets = np.arange(ls) * int_factor - w_pre*int_factor + int_factor
+
+        for start in range(0, nspk, batch_size):
+            intspikes = spikes[start:start + batch_size].astype(dtype, copy=False) @ operator.T
+
+            if detect == 'pos':
+                iaux = intspikes[:, peak_start:peak_end].argmax(axis=1)
+            elif detect == 'neg':
+                iaux = intspikes[:, peak_start:peak_end].argmin(axis=1)
+            elif detect == 'both':
+                iaux = np.abs(intspikes[:, peak_start:peak_end]).argmax(axis=1)
+
+            iaux = iaux + (w_pre+extra-1)*int_factor - 1
+
+            spikes_waveforms[start:start + batch_size] = np.take_along_axis(intspikes, iaux[:, np.newaxis] + offsets, axis=1)
 
     return spikes_waveforms
@@ -0,0 +1,70 @@
+# waveform_store.py
+import numpy as np
+
+
+class WaveformStore:
+    """The waveforms of the spikes of one channel, extracted once and shared by subset views.
+
+    A store holds the waveforms of all the detected spikes of a channel, with the sample
+    index of each spike. `select` returns views over a subset of the spikes, e.g. those kept
+    by artifacts removal, that share the same waveforms: nothing is extracted again, and the
+    rows of a view are only gathered when a dense array is needed
+    (`np.asarray(view)`, as the feature extraction does). Single rows are read from the
+    shared waveforms without copying.
+
+    Args:
+        waveforms (ndarray): Waveforms of shape (nspk, ls) of all the spikes.
+        indexes (ndarray): Sample index of each spike.
+        positions (ndarray): Rows of `waveforms` in the view, None for all of them.
+    """
+
+    def __init__(self, waveforms, indexes, positions=None):
+        self.waveforms = waveforms
+        self.all_indexes = np.asarray(indexes)
+        self._positions = positions
+
+    @property
+    def positions(self):
+        """Rows of the shared waveforms in this view."""
+        return np.arange(len(self.waveforms)) if self._positions is None else self._positions
+
+    @property
+    def indexes(self):
+        """Sample index of each spike of this view."""
+        return self.all_indexes if self._positions is None else self.all_indexes[self._positions]
+
+    def select(self, mask):
+        """Returns the view of the spikes of this view where the boolean `mask` is True."""
+        return WaveformStore(self.waveforms, self.all_indexes, self.positions[np.asarray(mask, dtype=bool)])
+
+    def __len__(self):
+        return len(self.waveforms) if self._positions is None else len(self._positions)
+
+    @property
+    def shape(self):
+        return (len(self),) + self.waveforms.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.waveforms.dtype
+
+    @property
+    def ndim(self):
+        return self.waveforms.ndim
+
+    def __getitem__(self, key):
+        if self._positions is None:
+            return self.waveforms[key]
+        if isinstance(key, tuple):
+            return self.waveforms[(self._positions[key[0]],) + key[1:]]
+        return self.waveforms[self._positions[key]]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.waveforms if self._positions is None else self.waveforms[self._positions]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+
+def waveform_stores(waveforms, spike_detection_results):
+    """Wraps the waveforms of each channel in a WaveformStore keyed by the detected sample indexes."""
+    return {channel_id: WaveformStore(channel_waveforms, spike_detection_results[channel_id]['indexes'])
+            for channel_id, channel_waveforms in waveforms.items()}
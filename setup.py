@@ -8,15 +8,18 @@ setup(
     author_email='khanim@uwm.edu',
     url='https://github.com/msdkhani/pywaveclus',
     packages=find_packages(),
+    package_data={'pywaveclus': ['config.yaml']},
     install_requires=[
         'spikeinterface',
         'numpy',
         'scipy',
         'pywt',
         'scikit-learn',
-        'statsmodels',
         'matplotlib',
         'pyyaml',
         'spclustering'
     ],
+    entry_points={
+        'console_scripts': ['pywaveclus-batch=pywaveclus.batch:main'],
+    },
 )
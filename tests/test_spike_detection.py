@@ -0,0 +1,155 @@
+# test_spike_detection.py
+import multiprocessing
+import numpy as np
+import pytest
+from spikeinterface.core import NumpyRecording
+
+from pywaveclus import spike_detection, waveform_extraction
+from pywaveclus.instrumentation import PipelineProfiler
+from pywaveclus.spike_detection import find_threshold_crossings, select_spikes_loop, select_spikes_vectorized
+from pywaveclus.waveform_extraction import extract_waveforms
+
+W_PRE = 20
+W_POST = 44
+REF = 45
+SAMPLE_REF = np.floor(REF / 2)
+THR = 4.0
+THRMAX = 50.0
+
+
+def add_spike(trace, position, amplitude):
+    """Adds a spike shaped like a negative peak (for a negative amplitude) at `position`."""
+    samples = np.arange(-8, 16)
+    shape = np.exp(-0.5 * (samples / 3.0) ** 2) - 0.3 * np.exp(-0.5 * ((samples - 8) / 4.0) ** 2)
+    window = slice(max(position - 8, 0), min(position + 16, len(trace)))
+    trace[window] += amplitude * shape[window.start - (position - 8):window.stop - (position - 8)]
+
+
+def synthetic_trace(num_samples=60000, seed=0, sign=-1):
+    """Returns a noise trace with spikes that collide within the refractory period, artifacts,
+    and spikes at the first and last samples where crossings are searched."""
+    rng = np.random.default_rng(seed)
+    trace = rng.normal(size=num_samples)
+    positions = np.sort(rng.choice(np.arange(200, num_samples - 200), 150, replace=False))
+    for position in positions:
+        add_spike(trace, position, sign * rng.uniform(6, 15))
+    # Pairs and bursts closer than the refractory period
+    for position in rng.choice(np.arange(300, num_samples - 300), 40, replace=False):
+        for offset in (0, rng.integers(5, REF), REF, REF + rng.integers(1, 10)):
+            add_spike(trace, position + offset, sign * rng.uniform(6, 15))
+    # Artifacts over thrmax, some of them next to real spikes
+    for position in rng.choice(np.arange(300, num_samples - 300), 15, replace=False):
+        add_spike(trace, position, sign * 80)
+        add_spike(trace, position + rng.integers(-REF, REF), sign * 10)
+    # Crossings at both ends of the range searched by find_threshold_crossings
+    first = W_PRE + 2
+    last = num_samples - W_POST - 3 - int(SAMPLE_REF)
+    for position in (first, first + 3, last - 3, last):
+        trace[position] = sign * 12
+    return trace
+
+
+@pytest.mark.parametrize('detect', ['neg', 'pos', 'both'])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_select_spikes_vectorized_matches_loop(detect, seed):
+    trace = synthetic_trace(seed=seed, sign=1 if detect == 'pos' else -1)
+    xaux = find_threshold_crossings(trace, THR, detect, W_PRE, W_POST, SAMPLE_REF)
+
+    expected = select_spikes_loop(trace, xaux, THRMAX, REF, SAMPLE_REF, W_PRE, W_POST)
+    # A small batch size also exercises the batching of the artifact check and alignment
+    for batch_size in (65536, 7):
+        index = select_spikes_vectorized(trace, xaux, THRMAX, REF, SAMPLE_REF, W_PRE, W_POST, batch_size=batch_size)
+        np.testing.assert_array_equal(index, expected)
+
+    # Some crossings fell within the refractory period of a spike, and some were artifacts
+    onsets = xaux[np.concatenate([[True], np.diff(xaux) > 1])]
+    without_artifacts = select_spikes_loop(trace, xaux, np.inf, REF, SAMPLE_REF, W_PRE, W_POST)
+    assert 100 < len(expected) < len(without_artifacts) < len(onsets)
+
+
+def test_select_spikes_edge_crossings():
+    trace = np.zeros(5000)
+    # Samples W_PRE + 2 to len - W_POST - 3 - SAMPLE_REF are searched, and a crossing is
+    # reported one sample before the sample over the threshold
+    first = W_PRE + 2
+    last = len(trace) - W_POST - 3 - int(SAMPLE_REF)
+    # The first and last searched samples, one past the range, and a collision with a spike
+    # just after the refractory period from the segment start
+    trace[[first, REF + 1, REF + 11, last, last + 1]] = -10
+    xaux = find_threshold_crossings(trace, THR, 'neg', W_PRE, W_POST, SAMPLE_REF)
+    np.testing.assert_array_equal(xaux, [first - 1, REF, REF + 10, last - 1])
+
+    expected = select_spikes_loop(trace, xaux, THRMAX, REF, SAMPLE_REF, W_PRE, W_POST)
+    index = select_spikes_vectorized(trace, xaux, THRMAX, REF, SAMPLE_REF, W_PRE, W_POST)
+    np.testing.assert_array_equal(index, expected)
+    # The refractory period starts at the segment start, so the first crossing is skipped
+    np.testing.assert_array_equal(expected, [REF + 1, last])
+
+
+def test_select_spikes_without_crossings():
+    trace = np.zeros(1000)
+    xaux = np.array([], dtype=int)
+    np.testing.assert_array_equal(select_spikes_vectorized(trace, xaux, THRMAX, REF, SAMPLE_REF, W_PRE, W_POST),
+                                  select_spikes_loop(trace, xaux, THRMAX, REF, SAMPLE_REF, W_PRE, W_POST))
+
+
+@pytest.mark.parametrize('segment_margin', [0, 5])
+def test_detect_spikes_engines_match(monkeypatch, segment_margin):
+    sr = 30000.
+    traces = np.stack([synthetic_trace(num_samples=150000, seed=seed) for seed in range(3)], axis=1)
+    recording = NumpyRecording(traces, sr)
+    config = spike_detection.load_spike_detection_config()
+    # Segments of 1 s, so that spikes fall near the segment boundaries
+    config.update(segment_duration=1 / 60, segment_margin=segment_margin, noise_method='median')
+
+    results = {}
+    for engine in ('loop', 'vectorized'):
+        monkeypatch.setattr(spike_detection, 'load_spike_detection_config', lambda: dict(config, detect_engine=engine))
+        results[engine] = spike_detection.detect_spikes(recording, recording, recording)
+
+    for channel_id in recording.get_channel_ids():
+        expected = results['loop'][channel_id]
+        result = results['vectorized'][channel_id]
+        assert len(expected['indexes']) > 100
+        np.testing.assert_array_equal(result['indexes'], expected['indexes'])
+        np.testing.assert_array_equal(result['spikes'], expected['spikes'])
+        np.testing.assert_array_equal(result['thresholds'], expected['thresholds'])
+    np.testing.assert_equal(extract_waveforms(results['vectorized'], recording), extract_waveforms(results['loop'], recording))
+
+
+@pytest.fixture
+def spawn_start_method():
+    """Starts the worker processes with 'spawn', so what they are passed must be picklable."""
+    start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method('spawn', force=True)
+    yield
+    multiprocessing.set_start_method(start_method, force=True)
+
+
+def test_segment_workers_with_spawn(monkeypatch, spawn_start_method):
+    traces = np.stack([synthetic_trace(num_samples=150000, seed=seed) for seed in range(2)], axis=1)
+    recording = NumpyRecording(traces, 30000.)
+    detection_config = dict(spike_detection.load_spike_detection_config(), segment_duration=1 / 60, segment_margin=5)
+    extraction_config = waveform_extraction.load_waveform_extraction_config()
+
+    outputs = {}
+    for segment_workers in (1, 2):
+        monkeypatch.setattr(spike_detection, 'load_spike_detection_config', lambda: dict(detection_config, segment_workers=segment_workers))
+        monkeypatch.setattr(waveform_extraction, 'load_waveform_extraction_config', lambda *args: dict(extraction_config, segment_workers=segment_workers))
+        # The pools get the recordings wrapped to count the bytes read, as in the pipeline
+        profiler = PipelineProfiler(verbose=False)
+        recording_bp2 = profiler.counting(recording)
+        with profiler.stage('detect_spikes'):
+            results = spike_detection.detect_spikes(recording, recording_bp2, profiler.counting(recording))
+        with profiler.stage('extract_waveforms'):
+            waveforms = waveform_extraction.extract_waveforms(results, recording_bp2)
+        outputs[segment_workers] = results, waveforms, {entry['stage']: entry['bytes_read'] for entry in profiler.entries}
+
+    (expected, expected_waveforms, _), (results, waveforms, bytes_read) = outputs[1], outputs[2]
+    for channel_id in recording.get_channel_ids():
+        assert len(expected[channel_id]['indexes']) > 100
+        np.testing.assert_array_equal(results[channel_id]['indexes'], expected[channel_id]['indexes'])
+        np.testing.assert_array_equal(waveforms[channel_id], expected_waveforms[channel_id])
+    # The reads of the worker processes are counted
+    assert bytes_read['detect_spikes'] == outputs[1][2]['detect_spikes']
+    assert bytes_read['extract_waveforms'] > 0